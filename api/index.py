@@ -1,46 +1,184 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import os
-from typing import Optional, List, Dict
+import asyncio
+from typing import Optional, List, Dict, Callable, BinaryIO, Awaitable, Deque
 import PyPDF2
 import io
+import gzip
 import json
+import traceback
 import mimetypes
 import pickle
 from pathlib import Path
 from datetime import datetime
 import uuid
 import hashlib
-from contextlib import contextmanager
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from itertools import islice
+import numpy as np
 
 # psycopg2 is optional; if missing we fall back to file storage
 try:
     import psycopg2
-    from psycopg2.extras import Json
+    import psycopg2.pool
+    from psycopg2.extras import Json, execute_values
     PSYCOPG2_AVAILABLE = True
 except ImportError:
     PSYCOPG2_AVAILABLE = False
     psycopg2 = None  # type: ignore
     Json = None  # type: ignore
+    execute_values = None  # type: ignore
     print("[WARNING] psycopg2 not installed; database mode disabled. Install psycopg2-binary to enable.")
 
+# faiss is optional; without it knowledge base search uses a NumPy flat scan
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+    faiss = None  # type: ignore
+    print("[WARNING] faiss not installed; using flat vector search. Install faiss-cpu to enable ANN indexing.")
+
+# numba is optional; it JIT-compiles the flat-scan scoring kernel, otherwise NumPy does the scan
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    numba = None  # type: ignore
+    print("[WARNING] numba not installed; using NumPy for flat vector scans. Install numba for a faster kernel.")
+
+# PyMuPDF (MuPDF bindings) is optional; it is the fastest PDF extractor when installed
+try:
+    import pymupdf
+    PYMUPDF_AVAILABLE = True
+except ImportError:
+    PYMUPDF_AVAILABLE = False
+    pymupdf = None  # type: ignore
+    print("[WARNING] PyMuPDF not installed; falling back to pypdfium2/PyPDF2 for PDF extraction. Install pymupdf for faster parsing.")
+
+# pypdfium2 (PDFium bindings) is optional; PyPDF2 is used when it is missing or fails
+try:
+    import pypdfium2 as pdfium
+    PDFIUM_AVAILABLE = True
+except ImportError:
+    PDFIUM_AVAILABLE = False
+    pdfium = None  # type: ignore
+    print("[WARNING] pypdfium2 not installed; using PyPDF2 for PDF extraction. Install pypdfium2 for faster parsing.")
+
+# poppler's pdftotext binary is optional; when present it handles large PDFs
+PDFTOTEXT_PATH = shutil.which("pdftotext")
+
+# rank_bm25 is optional; without it knowledge base search is vector-only
+try:
+    from rank_bm25 import BM25Okapi
+    BM25_AVAILABLE = True
+except ImportError:
+    BM25_AVAILABLE = False
+    BM25Okapi = None  # type: ignore
+    print("[WARNING] rank_bm25 not installed; keyword matching disabled. Install rank-bm25 for hybrid search.")
+
+# orjson is optional; it encodes and decodes JSON several times faster than the json module
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    orjson = None  # type: ignore
+    print("[WARNING] orjson not installed; using the json module. Install orjson for faster (de)serialization.")
+
 # Constants
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Read uploads in 64KB chunks
 ALLOWED_EXTENSIONS = {'.pdf', '.txt', '.md', '.docx', '.jpg', '.jpeg', '.png'}
+EXTRACTION_CACHE_SIZE = 128  # Extracted texts kept by upload content hash
+PDFTOTEXT_MIN_SIZE = 2 * 1024 * 1024  # PDFs larger than this go to pdftotext first
+PDFTOTEXT_TIMEOUT = 30  # Seconds before a pdftotext run is abandoned
+SEP = "=" * 80 + "\n"  # Section rule used in prompt context blocks
+MEMORY_CACHE_SIZE = 1024  # Sessions whose ConversationMemory stays loaded in this worker
+MEMORY_FLUSH_DELAY = 2.0  # Seconds file-backed history may stay unsaved, so a burst of turns is one write
+GZIP_MIN_RESPONSE_BYTES = 1024  # Smaller JSON responses are sent uncompressed
+MEMORY_GZIP_LEVEL = 1  # History files are gzip streams; level 1 already shrinks the repetitive JSON lines several-fold
+RECENT_CONTEXT_MESSAGES = 10  # Stored messages quoted verbatim in the chat prompt; older ones are summarized
+SUMMARY_EVERY_MESSAGES = 20  # Unsummarized older messages that trigger a summary refresh
+MAX_HISTORY_TOKENS = 4000  # Prompt budget for the client-sent chat history
+CHARS_PER_TOKEN = 4  # Rough characters-per-token ratio used for budgeting
+
+# Knowledge base retrieval
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_MAX_CHARS = 8000  # Keep embedding input within the model's token limit
+HNSW_MIN_DOCUMENTS = 1000  # Below this an exact NumPy scan is faster than HNSW
+HNSW_M = 32
+HNSW_EF_SEARCH = 64  # Candidate list size per HNSW query; faiss defaults to 16
+QUERY_CACHE_SIZE = 2048  # Cached query embeddings (exact text match), ~6MB of float32 vectors
+RESULT_CACHE_SIZE = 64  # Cached search results per KB
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Cosine similarity for reusing a cached search result
+# SQLite files live here; serverless bundles (Vercel) are read-only outside /tmp
+KB_DATA_DIR = Path(os.getenv("KB_DATA_DIR", "/tmp/bassist" if os.getenv("VERCEL") else "."))
+KB_STORAGE_FILE = str(KB_DATA_DIR / "kb_storage.db")  # Knowledge bases and their documents, shared by all workers
+LEGACY_KB_PICKLE_FILE = "kb_storage.pkl"  # Pre-SQLite storage, imported once on startup
+KB_EMBEDDINGS_FILE = str(KB_DATA_DIR / "kb_embeddings.db")  # Persisted document embeddings, keyed by content hash
+INT8_SCALE = 127  # Stored vectors are int8(round(v * 127)); 4x smaller than float32
+SCAN_BLOCK_ROWS = 4096  # Rows dequantized at a time during a flat scan
+EMBEDDING_MIN_CAPACITY = 128  # Initial rows allocated for a KB's embedding matrix; doubled as it fills
+CHUNK_SIZE = 2048  # Characters per embedded passage (~512 tokens)
+CHUNK_OVERLAP = 256  # Characters shared by consecutive passages
+HYBRID_CANDIDATES = 20  # Passages taken from each of the vector and BM25 rankings before fusion
+RRF_K = 60  # Reciprocal-rank fusion constant
+
+# Worker threads behind asyncio.to_thread (PDF parsing, embedding calls, KB search)
+THREAD_POOL_WORKERS = int(os.getenv("THREAD_POOL_WORKERS", str((os.cpu_count() or 1) * 2)))
 
 # Database Configuration (Vercel-compatible)
 DATABASE_URL = os.getenv("DATABASE_URL") if PSYCOPG2_AVAILABLE else None
 
 # Fallback to file-based storage if no database URL or driver is provided
 USE_DATABASE = bool(DATABASE_URL) and PSYCOPG2_AVAILABLE
+DB_POOL_MIN_CONNECTIONS = 1
+# Every worker thread plus the event loop may hold a connection at once
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", str(max(10, THREAD_POOL_WORKERS + 1))))
+DB_POOL_TIMEOUT = 30  # Seconds to wait for a free pooled connection before giving up
 if not USE_DATABASE:
     CONVERSATION_STORAGE_DIR = Path("./conversation_memory")
     CONVERSATION_STORAGE_DIR.mkdir(exist_ok=True)
 
 # Initialize FastAPI app
-app = FastAPI(title="BAssist AI API")
+app = FastAPI(
+    title="BAssist AI API",
+    default_response_class=ORJSONResponse if ORJSON_AVAILABLE else JSONResponse,
+)
+
+@app.on_event("startup")
+async def configure_thread_pool():
+    """Size the default executor used for blocking work"""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS, thread_name_prefix="bassist-worker")
+    )
+
+@app.on_event("startup")
+async def warm_scan_kernel():
+    """Compile the flat-scan kernel before the first query needs it"""
+    if NUMBA_AVAILABLE:
+        await asyncio.to_thread(_int8_scores, np.zeros((1, 1), dtype=np.int8), np.zeros(1, dtype=np.float32))
+
+@app.on_event("shutdown")
+async def flush_conversation_memories():
+    """Write any file-backed history still waiting for its delayed save"""
+    for memory in conversation_memories.values():
+        memory.flush()
 
 # Health check endpoint
 @app.get("/api/health")
@@ -55,6 +193,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Long histories (/api/memory/...) and KB document listings compress several-fold
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_RESPONSE_BYTES)
 
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -63,6 +203,106 @@ if not GEMINI_API_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
+# Shared model clients, built once per worker instead of per request
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+# A lighter model condenses old conversation turns into the rolling summary
+GEMINI_SUMMARY_MODEL_NAME = os.getenv("GEMINI_SUMMARY_MODEL", "gemini-2.5-flash-lite")
+gemini_summary_model = genai.GenerativeModel(GEMINI_SUMMARY_MODEL_NAME)
+try:
+    gemini_search_model = genai.GenerativeModel(GEMINI_MODEL_NAME, tools='google_search_retrieval')
+except Exception as e:
+    # Older SDKs reject the search tool; fact-check then falls back to model knowledge only
+    gemini_search_model = None
+    print(f"[WARNING] Google Search grounding unavailable: {e}")
+
+# Cap in-flight Gemini calls per worker to stay under the API rate limits
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", "5"))
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_RETRY_BASE_DELAY = 1.0  # Seconds; doubled after each rate-limited attempt
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENT)
+
+async def gemini_generate(model: genai.GenerativeModel, prompt: str, stream: bool = False):
+    """Call Gemini under the concurrency cap, retrying rate-limit errors with exponential backoff.
+    
+    A streamed call is still running when its response object comes back, so stream=True
+    takes no slot here; gemini_event_stream holds one until the stream is drained.
+    """
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            async with (nullcontext() if stream else gemini_semaphore):
+                return await model.generate_content_async(prompt, stream=stream)
+        except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable) as e:
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            delay = GEMINI_RETRY_BASE_DELAY * 2 ** attempt
+            print(f"[WARNING] Gemini rate limited ({e.__class__.__name__}), retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+class GeminiDispatcher:
+    """Coalesce identical in-flight Gemini prompts into a single API call"""
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+    
+    async def submit(self, model: genai.GenerativeModel, prompt: str):
+        """Generate a response, joining an identical request that is already running"""
+        key = (model.model_name, hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(gemini_generate(model, prompt))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one client disconnecting does not cancel the call for the others
+        return await asyncio.shield(future)
+
+gemini_dispatcher = GeminiDispatcher()
+
+# The loop only holds weak references to tasks, so fire-and-forget work is kept here until it finishes
+_background_tasks: set = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Run coro as a detached task that cannot be garbage-collected mid-run and whose failure is logged"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[ERROR] Background task failed: {task.exception()!r}")
+
+def sse_event(payload: Dict) -> str:
+    """Format one server-sent event"""
+    data = orjson.dumps(payload).decode("utf-8") if ORJSON_AVAILABLE else json.dumps(payload, ensure_ascii=False)
+    return f"data: {data}\n\n"
+
+def gemini_event_stream(model: genai.GenerativeModel, prompt: str,
+                        on_complete: Callable[[str], Awaitable[Dict]]) -> StreamingResponse:
+    """Stream a Gemini response to prompt as server-sent events.
+    
+    Each text chunk is sent as {"delta": ...}. Once the stream ends, on_complete is
+    awaited with the full text and its result is sent in the final {"done": true} event.
+    The generation counts against GEMINI_MAX_CONCURRENT until its last chunk is relayed.
+    """
+    async def event_generator():
+        parts = []
+        try:
+            async with gemini_semaphore:
+                response = await gemini_generate(model, prompt, stream=True)
+                async for chunk in response:
+                    parts.append(chunk.text)
+                    yield sse_event({"delta": chunk.text})
+            yield sse_event({"done": True, **(await on_complete("".join(parts)))})
+        except Exception as e:
+            print(f"[ERROR] Gemini stream: {str(e)}")
+            yield sse_event({"done": True, "success": False, "detail": str(e)})
+    
+    # GZipMiddleware buffers compressed output, which would hold back events; declaring an encoding opts out
+    return StreamingResponse(
+        event_generator(), media_type="text/event-stream", headers={"Content-Encoding": "identity"}
+    )
+
 # Pydantic models for request validation
 class TextRequest(BaseModel):
     text: str
@@ -75,68 +315,259 @@ class DocumentRequest(BaseModel):
     text: str
     query: Optional[str] = None
 
+class ChatForm(BaseModel):
+    """JSON payload of the `request` form field on the text endpoints"""
+    text: str = ""
+    history: List[Dict] = []
+    knowledge_base: Optional[str] = None
+    session_id: Optional[str] = None
+    stream: bool = False
+
+class KBForm(BaseModel):
+    """JSON payload of the `request` form field on the knowledge base endpoints"""
+    name: str = ""
+
 # Helper function to extract text from files
+def _extract_pdf_pymupdf(stream: BinaryIO) -> str:
+    """Extract PDF text with MuPDF (C), the fastest available backend"""
+    with pymupdf.open(stream=stream.read(), filetype="pdf") as doc:
+        return "\n".join(page.get_text("text", sort=False) for page in doc)
+
+def _extract_pdf_pdfium(stream: BinaryIO) -> str:
+    """Extract PDF text with PDFium (C++), much faster than pure-Python PyPDF2"""
+    pdf = pdfium.PdfDocument(stream)
+    try:
+        parts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            parts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return "\n".join(parts)
+    finally:
+        pdf.close()
+
+def _extract_pdf_pypdf2(stream: BinaryIO) -> str:
+    """Fallback PDF text extraction with PyPDF2"""
+    pdf_reader = PyPDF2.PdfReader(stream)
+    # Walk the page tree once; pages without a text layer return None
+    return "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+
+def _extract_pdf_pdftotext(stream: BinaryIO) -> str:
+    """Extract PDF text with poppler's pdftotext, avoiding Python per-page overhead on large files"""
+    proc = subprocess.run(
+        [PDFTOTEXT_PATH, "-q", "-", "-"],
+        input=stream.read(), capture_output=True, timeout=PDFTOTEXT_TIMEOUT, check=True
+    )
+    return proc.stdout.decode("utf-8", errors="ignore")
+
+# Installed PDF backends, fastest first; PyPDF2 is always last
+PDF_EXTRACTORS = [
+    (name, extract) for name, extract, available in (
+        ("PyMuPDF", _extract_pdf_pymupdf, PYMUPDF_AVAILABLE),
+        ("pypdfium2", _extract_pdf_pdfium, PDFIUM_AVAILABLE),
+    ) if available
+] + [("PyPDF2", _extract_pdf_pypdf2)]
+
+def _extract_text_sync(stream: BinaryIO, ext: str, filename: str) -> str:
+    """Blocking text extraction for a validated upload, run in a worker thread"""
+    # PDF files: try each backend in turn, falling back on PDFs it cannot read
+    if ext == '.pdf':
+        extractors = PDF_EXTRACTORS
+        size = stream.seek(0, io.SEEK_END)
+        stream.seek(0)
+        if PDFTOTEXT_PATH and size > PDFTOTEXT_MIN_SIZE:
+            extractors = [("pdftotext", _extract_pdf_pdftotext)] + extractors
+        for name, extract in extractors[:-1]:
+            try:
+                return extract(stream)
+            except Exception as e:
+                print(f"[WARNING] {name} could not read {filename}, trying the next PDF backend: {e}")
+                stream.seek(0)
+        return extractors[-1][1](stream)
+    
+    # Text files
+    elif ext in ('.txt', '.md', '.docx'):
+        return stream.read().decode('utf-8', errors='ignore')
+    
+    # Image files
+    elif ext in ('.jpg', '.jpeg', '.png'):
+        return f"[Tệp hình ảnh: {filename}]"
+    
+    # Default: try to decode as text
+    else:
+        return stream.read().decode('utf-8', errors='ignore')
+
+class ExtractionCache:
+    """LRU cache of extracted text keyed by the upload's extension and content hash"""
+    def __init__(self, maxsize: int = EXTRACTION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._cache: OrderedDict = OrderedDict()
+    
+    def get(self, key: tuple) -> Optional[str]:
+        text = self._cache.get(key)
+        if text is not None:
+            self._cache.move_to_end(key)
+        return text
+    
+    def put(self, key: tuple, text: str):
+        self._cache[key] = text
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+extraction_cache = ExtractionCache()
+
+def _scan_upload(stream: BinaryIO) -> tuple:
+    """Read an upload's spooled file in chunks, returning (size, BLAKE2b digest); stops early past MAX_FILE_SIZE"""
+    digest = hashlib.blake2b(digest_size=16)
+    size = 0
+    stream.seek(0)
+    while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_FILE_SIZE:
+            break
+        digest.update(chunk)
+    stream.seek(0)
+    return size, digest.hexdigest()
+
 async def extract_text_from_file(file: UploadFile) -> str:
     """Extract text content from uploaded files with validation"""
     try:
-        content = await file.read()
-        
-        # Validate file size
-        if len(content) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=400, detail=f"File quá lớn. Tối đa {MAX_FILE_SIZE / 1024 / 1024}MB")
-        
         filename = file.filename.lower()
         ext = Path(filename).suffix
         
-        # Validate extension
+        # Validate extension before reading the body
         if ext not in ALLOWED_EXTENSIONS:
             raise HTTPException(status_code=400, detail=f"Định dạng file không được hỗ trợ: {ext}")
         
-        # PDF files
-        if ext == '.pdf':
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-            return text
-        
-        # Text files
-        elif ext in ('.txt', '.md', '.docx'):
-            return content.decode('utf-8', errors='ignore')
-        
-        # Image files
-        elif ext in ('.jpg', '.jpeg', '.png'):
-            return f"[Tệp hình ảnh: {filename}]"
-        
-        # Default: try to decode as text
-        else:
-            return content.decode('utf-8', errors='ignore')
+        # Starlette has already spooled the body into file.file; parse it in place rather than copying it.
+        # The recorded size allows rejecting oversized uploads without reading them.
+        too_large = HTTPException(status_code=400, detail=f"File quá lớn. Tối đa {MAX_FILE_SIZE / 1024 / 1024}MB")
+        if file.size is not None and file.size > MAX_FILE_SIZE:
+            raise too_large
+        size, content_hash = await asyncio.to_thread(_scan_upload, file.file)
+        if size > MAX_FILE_SIZE:
+            raise too_large
+        
+        # Re-uploads of the same file skip parsing; image placeholders embed the filename, so they are not cached
+        cache_key = (ext, content_hash)
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        # Parse off the event loop so other requests (and concurrent extractions) keep running
+        text = await asyncio.to_thread(_extract_text_sync, file.file, ext, filename)
+        if ext not in ('.jpg', '.jpeg', '.png'):
+            extraction_cache.put(cache_key, text)
+        return text
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Lỗi đọc tệp: {str(e)}")
 
+async def extract_texts_from_files(files: Optional[List[UploadFile]]) -> List[tuple]:
+    """Extract text from all uploaded files concurrently, as (filename, text) pairs in upload order"""
+    async def _process(file: UploadFile):
+        return file.filename, await extract_text_from_file(file)
+    
+    return await asyncio.gather(*(_process(f) for f in files or [] if f and f.filename))
+
+def _json_loads(data):
+    """Decode JSON from str or bytes, with orjson when it is installed"""
+    return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+
+def _json_line(obj) -> bytes:
+    """Encode obj as one UTF-8 JSON line for the .jsonl.gz history files"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj) + b"\n"
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def _epoch_ms(moment: datetime) -> int:
+    """Milliseconds since the Unix epoch, the format message timestamps are stored and returned in"""
+    return int(moment.timestamp() * 1000)
+
+def _parse_request(request: Optional[str]) -> Dict:
+    """Parse the JSON `request` form field; anything that is not a JSON object is taken as the text"""
+    if not request:
+        return {}
+    try:
+        # orjson.JSONDecodeError subclasses ValueError, so one handler covers both decoders
+        request_data = _json_loads(request)
+    except ValueError:
+        return {"text": request}
+    return request_data if isinstance(request_data, dict) else {"text": request}
+
+def _validate_form(model: type, request: Optional[str]):
+    """Decode the `request` form field into model, rejecting bad field types with a 422"""
+    try:
+        return model.model_validate(_parse_request(request))
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+async def parse_form(request: Optional[str] = Form(None)) -> ChatForm:
+    """Dependency for endpoints taking text, history, knowledge_base, session_id and stream"""
+    return _validate_form(ChatForm, request)
+
+async def parse_kb_form(request: Optional[str] = Form(None)) -> KBForm:
+    """Dependency for knowledge base endpoints taking a name"""
+    return _validate_form(KBForm, request)
+
 # Helper functions for context and prompt building
 
 # ==================== Database Connection ====================
 
+_db_pool = None
+_db_pool_lock = threading.Lock()
+# getconn() raises PoolError instead of waiting when the pool is exhausted, so borrowers queue here
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONNECTIONS)
+
+def get_db_pool():
+    """Create the shared connection pool on first use, so connections (and TLS handshakes) are reused"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN_CONNECTIONS,
+                DB_POOL_MAX_CONNECTIONS,
+                DATABASE_URL,
+                sslmode='require' if DATABASE_URL and 'vercel' in DATABASE_URL else 'disable'
+            )
+        return _db_pool
+
 @contextmanager
 def get_db_connection():
-    """Get database connection (works on Vercel)"""
+    """Borrow a pooled database connection (works on Vercel)"""
     if not USE_DATABASE or not psycopg2:
         # Explicitly yield None so callers can gracefully fall back to file storage
         yield None
         return
 
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require' if DATABASE_URL and 'vercel' in DATABASE_URL else 'disable')
-        yield conn
-        conn.close()
-    except Exception as e:
-        print(f"[WARNING] Database connection failed: {e}")
-        # Yield None so callers can choose file fallback instead of crashing
-        yield None
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        print(f"[WARNING] No database connection free after {DB_POOL_TIMEOUT}s")
         yield None
+        return
+    try:
+        try:
+            db_pool = get_db_pool()
+            conn = db_pool.getconn()
+        except Exception as e:
+            print(f"[WARNING] Database connection failed: {e}")
+            # Yield None so callers can choose file fallback instead of crashing
+            yield None
+            return
+
+        try:
+            yield conn
+        finally:
+            # Return the connection clean: drop any transaction the caller left open
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            db_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _db_pool_slots.release()
 
 def init_database():
     """Initialize database tables"""
@@ -154,6 +585,9 @@ def init_database():
                         message_count INTEGER DEFAULT 0
                     )
                 ''')
+                # Rolling summary of the messages before summary_upto
+                cursor.execute('ALTER TABLE conversation_sessions ADD COLUMN IF NOT EXISTS summary TEXT')
+                cursor.execute('ALTER TABLE conversation_sessions ADD COLUMN IF NOT EXISTS summary_upto INTEGER DEFAULT 0')
                 
                 # Messages table
                 cursor.execute('''
@@ -183,11 +617,14 @@ def init_database():
                     )
                 ''')
                 
-                # Indexes
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_session_id ON conversation_messages(session_id)')
+                # Indexes; the composite ones match the history/memory queries' WHERE + ORDER BY,
+                # so rows come back pre-sorted, and they supersede the old single-column session indexes
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_msgs_session_ts ON conversation_messages(session_id, timestamp, id)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON conversation_messages(timestamp)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_memory_session ON ai_user_memory(session_id)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_memory_session_updated ON ai_user_memory(session_id, updated_at DESC)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_memory_type ON ai_user_memory(memory_type)')
+                cursor.execute('DROP INDEX IF EXISTS idx_session_id')
+                cursor.execute('DROP INDEX IF EXISTS idx_ai_memory_session')
                 
                 conn.commit()
                 print("[INFO] Database tables initialized")
@@ -200,19 +637,110 @@ if USE_DATABASE:
 
 # ==================== Conversation Memory System (Database-backed) ====================
 
+class SessionIndex:
+    """SQLite table of message_count/updated_at per file-backed session, shared by all workers"""
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        try:
+            self._conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        except Exception as e:
+            print(f"[WARNING] Session index unavailable on disk, keeping it in memory: {e}")
+            self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL,
+                updated_at TEXT
+            )
+        ''')
+        self._conn.commit()
+        self._build_once()
+    
+    def _build_once(self):
+        """Fill the table from the history files the first time any worker opens it"""
+        with self._lock, self._conn:
+            # IMMEDIATE takes the write lock, so workers starting together scan only once
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0]:
+                return
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (session_id, message_count, updated_at) VALUES (?, ?, ?)",
+                _scan_history_files()
+            )
+            self._conn.execute("PRAGMA user_version = 1")
+        # Written by the earlier JSON version of the index
+        (CONVERSATION_STORAGE_DIR / "index.json").unlink(missing_ok=True)
+    
+    def update(self, session_id: str, message_count: int):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, message_count, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET message_count = excluded.message_count, updated_at = excluded.updated_at",
+                (session_id, message_count, datetime.now().isoformat())
+            )
+    
+    def remove(self, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+    
+    def list_sessions(self) -> List[tuple]:
+        """(session_id, message_count, updated_at) for every session"""
+        with self._lock:
+            return self._conn.execute("SELECT session_id, message_count, updated_at FROM sessions").fetchall()
+
+def _scan_history_files() -> List[tuple]:
+    """(session_id, message_count, updated_at) read from every history file on disk"""
+    index = {}
+    for suffix, opener in ((".jsonl", open), (".jsonl.gz", gzip.open)):
+        for memory_file in CONVERSATION_STORAGE_DIR.glob(f"user_*{suffix}"):
+            try:
+                with opener(memory_file, "rb") as f:
+                    message_count = sum(1 for line in f if line.strip())
+                index[memory_file.name[len("user_"):-len(suffix)]] = (
+                    message_count, datetime.fromtimestamp(memory_file.stat().st_mtime).isoformat()
+                )
+            except (OSError, EOFError) as e:
+                print(f"[WARNING] Skipping unreadable memory file {memory_file}: {e}")
+    # Sessions not loaded since the switch to .jsonl still have the old format
+    for memory_file in CONVERSATION_STORAGE_DIR.glob("user_*.json"):
+        try:
+            with open(memory_file, "rb") as f:
+                data = _json_loads(f.read())
+            index.setdefault(data.get("user_id"), (len(data.get("conversations", [])), data.get("updated_at")))
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] Skipping unreadable memory file {memory_file}: {e}")
+    return [(session_id, count, updated_at) for session_id, (count, updated_at) in index.items()]
+
+session_index = None if USE_DATABASE else SessionIndex(CONVERSATION_STORAGE_DIR / "index.db")
+
 class ConversationMemory:
     """Persistent conversation memory with database backend"""
     
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, new_session: bool = False):
         self.user_id = user_id
         self.conversations: List[Dict] = []
+        self._context_cache: Optional[tuple] = None  # (message count, max_messages, rendered context)
+        self._pending: Deque[Dict] = deque()  # File-backed messages not yet appended to memory_file
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._write_lock = threading.Lock()  # History writes run in worker threads as well as inline
+        self.summary = ""  # Condensed form of conversations[:summary_upto]
+        self.summary_upto = 0
+        self._summary_task: Optional[asyncio.Task] = None
+        self._discarded = False  # Set once the history is deleted, so late writes cannot recreate it
         if USE_DATABASE:
             self._init_session()
-            self.load_memory()
+            if not new_session:
+                self.load_memory()
         else:
             # Fallback to file-based
-            self.memory_file = CONVERSATION_STORAGE_DIR / f"user_{user_id}.json"
-            self.load_memory()
+            # One JSON message per line, so each turn is an append rather than a rewrite
+            self.memory_file = CONVERSATION_STORAGE_DIR / f"user_{user_id}.jsonl.gz"
+            self.plain_memory_file = CONVERSATION_STORAGE_DIR / f"user_{user_id}.jsonl"  # Written before compression
+            self.legacy_memory_file = CONVERSATION_STORAGE_DIR / f"user_{user_id}.json"
+            self.summary_file = CONVERSATION_STORAGE_DIR / f"summary_{user_id}.json"
+            if not new_session:
+                self.load_memory()
     
     def _init_session(self):
         """Initialize session in database"""
@@ -241,18 +769,25 @@ class ConversationMemory:
                             SELECT role, content, timestamp, kb_name 
                             FROM conversation_messages 
                             WHERE session_id = %s 
-                            ORDER BY timestamp ASC
+                            ORDER BY timestamp ASC, id ASC
                         ''', (self.user_id,))
                         rows = cursor.fetchall()
                         self.conversations = [
                             {
                                 "role": row[0],
                                 "content": row[1],
-                                "timestamp": row[2].isoformat() if row[2] else None,
+                                "ts": _epoch_ms(row[2]) if row[2] else None,
                                 "kb": row[3]
                             }
                             for row in rows
                         ]
+                        cursor.execute(
+                            'SELECT summary, summary_upto FROM conversation_sessions WHERE session_id = %s',
+                            (self.user_id,)
+                        )
+                        row = cursor.fetchone()
+                        if row and row[0]:
+                            self.summary, self.summary_upto = row[0], row[1] or 0
                         print(f"[INFO] Loaded {len(self.conversations)} messages for user {self.user_id}")
                     else:
                         self._load_from_file()
@@ -266,107 +801,307 @@ class ConversationMemory:
         """Fallback: Load from file"""
         try:
             if self.memory_file.exists():
-                with open(self.memory_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    self.conversations = data.get("conversations", [])
+                self.conversations, corrupt = self._read_lines(gzip.open(self.memory_file, "rb"))
+                if corrupt:
+                    # A crash mid-append can leave a torn member; rewrite without it so later appends stay readable
+                    print(f"[WARNING] Dropped corrupt lines from {self.memory_file}")
+                    self._save_to_file()
+                elif self._upgrade_timestamps():
+                    self._save_to_file()
+            elif self.plain_memory_file.exists():
+                # Convert the uncompressed .jsonl file once
+                self.conversations, _ = self._read_lines(open(self.plain_memory_file, "rb"))
+                self._upgrade_timestamps()
+                self._save_to_file()
+                self.plain_memory_file.unlink()
+            elif self.legacy_memory_file.exists():
+                # Convert the older single-document JSON file once
+                with open(self.legacy_memory_file, "rb") as f:
+                    self.conversations = _json_loads(f.read()).get("conversations", [])
+                self._upgrade_timestamps()
+                self._save_to_file()
+                self.legacy_memory_file.unlink()
+            if self.summary_file.exists():
+                with open(self.summary_file, "rb") as f:
+                    data = _json_loads(f.read())
+                # A summary covering more messages than exist outlived its history, e.g. one deleted mid-refresh
+                if data.get("summary_upto", 0) <= len(self.conversations):
+                    self.summary, self.summary_upto = data.get("summary", ""), data.get("summary_upto", 0)
         except Exception as e:
             print(f"[WARNING] Failed to load from file: {e}")
             self.conversations = []
     
-    def save_memory(self):
-        """Save conversation to database or file"""
-        try:
-            if USE_DATABASE:
-                with get_db_connection() as conn:
-                    if conn:
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            'UPDATE conversation_sessions SET updated_at = CURRENT_TIMESTAMP, message_count = %s WHERE session_id = %s',
-                            (len(self.conversations), self.user_id)
-                        )
-                        conn.commit()
-                    else:
-                        self._save_to_file()
-            else:
-                self._save_to_file()
-        except Exception as e:
-            print(f"[WARNING] Failed to save memory: {e}")
-            self._save_to_file()
+    def _upgrade_timestamps(self) -> bool:
+        """Replace ISO "timestamp" strings written by older versions with epoch-ms "ts"; True if any changed"""
+        changed = False
+        for msg in self.conversations:
+            if "timestamp" in msg:
+                value = msg.pop("timestamp")
+                msg["ts"] = _epoch_ms(datetime.fromisoformat(value)) if value else None
+                changed = True
+        return changed
+    
+    @staticmethod
+    def _read_lines(f: BinaryIO) -> tuple:
+        """Parse a JSON-lines history; returns (messages, whether anything unreadable was skipped)"""
+        messages, corrupt = [], False
+        with f:
+            try:
+                for line in f:
+                    try:
+                        messages.append(_json_loads(line))
+                    except ValueError:
+                        corrupt = True
+            except (OSError, EOFError):
+                # Truncated or damaged gzip data: keep every line decoded before it
+                corrupt = True
+        return messages, corrupt
     
     def _save_to_file(self):
         """Fallback: Save to file"""
         try:
-            with open(self.memory_file, "w", encoding="utf-8") as f:
-                json.dump({
-                    "user_id": self.user_id,
-                    "updated_at": datetime.now().isoformat(),
-                    "conversations": self.conversations
-                }, f, ensure_ascii=False, indent=2)
+            with self._write_lock:
+                # Rewrite the whole history, then swap it in so readers never see a partial file
+                tmp_file = self.memory_file.with_suffix(".gz.tmp")
+                with open(tmp_file, "wb") as f:
+                    f.write(gzip.compress(b"".join(_json_line(msg) for msg in self.conversations), MEMORY_GZIP_LEVEL))
+                os.replace(tmp_file, self.memory_file)
+                self._pending.clear()
+                self._update_index()
         except Exception as e:
             print(f"[ERROR] Failed to save to file: {e}")
     
+    def _append_to_file(self, msgs: List[Dict]):
+        """Append messages to the history file with one write and fsync"""
+        try:
+            # Concatenated gzip members read back as one stream, so appending never recompresses the history
+            with open(self.memory_file, "ab") as f:
+                f.write(gzip.compress(b"".join(_json_line(msg) for msg in msgs), MEMORY_GZIP_LEVEL))
+                f.flush()
+                os.fsync(f.fileno())
+            self._update_index()
+        except Exception as e:
+            print(f"[ERROR] Failed to append to file: {e}")
+    
+    def _update_index(self):
+        """Keep this session's entry in the session index current for list_all_memories"""
+        session_index.update(self.user_id, len(self.conversations))
+    
+    def _schedule_flush(self, msgs: List[Dict]):
+        """Queue messages for the history file and append them once MEMORY_FLUSH_DELAY has passed"""
+        self._pending.extend(msgs)
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Called outside the event loop: nothing will run a timer, so write now
+            self._write_pending()
+            return
+        self._flush_handle = loop.call_later(MEMORY_FLUSH_DELAY, self._flush_in_background)
+    
+    def _flush_in_background(self):
+        """Timer callback: hand the gzip/write/fsync to a worker thread instead of blocking the loop"""
+        self._flush_handle = None
+        asyncio.get_running_loop().run_in_executor(None, self._write_pending)
+    
+    def _write_pending(self):
+        # Drain under the lock so concurrent writers append batches in the order they were queued
+        with self._write_lock:
+            msgs = []
+            while self._pending:
+                msgs.append(self._pending.popleft())
+            if msgs:
+                self._append_to_file(msgs)
+    
+    def _cancel_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+    
+    def flush(self):
+        """Write pending file-backed messages to disk"""
+        self._cancel_flush()
+        self._write_pending()
+    
+    async def flush_async(self):
+        """flush from the event loop, with the write in a worker thread"""
+        self._cancel_flush()
+        await asyncio.to_thread(self._write_pending)
+    
+    def discard(self):
+        """Drop scheduled writes and any summary refresh because the history is being deleted"""
+        self._cancel_flush()
+        if self._summary_task is not None:
+            self._summary_task.cancel()
+        # Under the lock, so a summary save already in a worker thread finishes before the files are unlinked
+        with self._write_lock:
+            self._discarded = True
+            self._pending.clear()
+    
     def add_message(self, role: str, content: str, kb_name: Optional[str] = None):
         """Add message to history"""
-        try:
-            timestamp = datetime.now()
-            msg = {
+        self.add_messages([(role, content)], kb_name)
+    
+    def add_messages(self, messages: List[tuple], kb_name: Optional[str] = None):
+        """Add (role, content) messages, e.g. a whole chat turn, in a single write"""
+        timestamp = datetime.now()
+        msgs = [
+            {
                 "role": role,
                 "content": content,
-                "timestamp": timestamp.isoformat(),
+                "ts": _epoch_ms(timestamp),
                 "kb": kb_name
             }
-            
+            for role, content in messages
+        ]
+        self._context_cache = None
+        
+        if USE_DATABASE:
+            try:
+                with get_db_connection() as conn:
+                    if conn:
+                        cursor = conn.cursor()
+                        # Insert the rows and bump the session counter in one statement (one round trip)
+                        execute_values(
+                            cursor,
+                            '''
+                                WITH ins AS (
+                                    INSERT INTO conversation_messages (session_id, role, content, timestamp, kb_name)
+                                    VALUES %s RETURNING session_id
+                                )
+                                UPDATE conversation_sessions
+                                SET updated_at = CURRENT_TIMESTAMP, message_count = message_count + (SELECT COUNT(*) FROM ins)
+                                WHERE session_id = (SELECT session_id FROM ins LIMIT 1)
+                            ''',
+                            [(self.user_id, msg["role"], msg["content"], timestamp, kb_name) for msg in msgs],
+                            page_size=100
+                        )
+                        conn.commit()
+                        self.conversations.extend(msgs)
+                        return
+            except Exception as e:
+                print(f"[WARNING] Failed to add messages: {e}")
+            # There is no history file in database mode to fall back to
+            print(f"[ERROR] {len(msgs)} messages for session {self.user_id} kept in memory only, not persisted")
+            self.conversations.extend(msgs)
+            return
+        
+        self.conversations.extend(msgs)
+        self._schedule_flush(msgs)
+    
+    async def add_messages_async(self, messages: List[tuple], kb_name: Optional[str] = None):
+        """add_messages for use from the event loop: database writes go to a worker thread"""
+        if USE_DATABASE:
+            await asyncio.to_thread(self.add_messages, messages, kb_name)
+        else:
+            # File mode only buffers and schedules a flush on the loop
+            self.add_messages(messages, kb_name)
+        self.schedule_summary()
+    
+    def schedule_summary(self):
+        """Start a background summary refresh once enough older messages have piled up"""
+        upto = len(self.conversations) - RECENT_CONTEXT_MESSAGES
+        if self._summary_task is not None or upto - self.summary_upto < SUMMARY_EVERY_MESSAGES:
+            return
+        self._summary_task = spawn_background(self._refresh_summary(upto))
+    
+    async def _refresh_summary(self, upto: int):
+        """Fold conversations[summary_upto:upto] into the rolling summary"""
+        try:
+            lines = "\n".join(
+                f"{'Người dùng' if msg['role'] == 'user' else 'AI'}: {msg['content'][:1000]}"
+                for msg in self.conversations[self.summary_upto:upto]
+            )
+            prompt = f"""Cập nhật bản tóm tắt cuộc trò chuyện giữa người dùng và trợ lý AI (bằng TIẾNG VIỆT).
+Giữ lại: thông tin cá nhân người dùng đã chia sẻ, mục tiêu, các chủ đề và kết luận chính.
+
+Tóm tắt hiện tại:
+{self.summary or "(chưa có)"}
+
+Các tin nhắn mới cần gộp vào:
+{lines}
+
+Bản tóm tắt cập nhật (tối đa 200 từ):"""
+            response = await gemini_generate(gemini_summary_model, prompt)
+            self.summary, self.summary_upto = response.text.strip(), upto
+            self._context_cache = None
+            await asyncio.to_thread(self._save_summary)
+        except Exception as e:
+            print(f"[WARNING] Failed to refresh conversation summary: {e}")
+        finally:
+            self._summary_task = None
+    
+    def _save_summary(self):
+        """Persist the rolling summary next to the history, unless the history has been deleted meanwhile"""
+        with self._write_lock:
+            if self._discarded:
+                return
             if USE_DATABASE:
                 with get_db_connection() as conn:
                     if conn:
                         cursor = conn.cursor()
-                        cursor.execute('''
-                            INSERT INTO conversation_messages (session_id, role, content, timestamp, kb_name)
-                            VALUES (%s, %s, %s, %s, %s)
-                        ''', (self.user_id, role, content, timestamp, kb_name))
+                        cursor.execute(
+                            'UPDATE conversation_sessions SET summary = %s, summary_upto = %s WHERE session_id = %s',
+                            (self.summary, self.summary_upto, self.user_id)
+                        )
                         conn.commit()
-                    else:
-                        self.conversations.append(msg)
-                        self._save_to_file()
             else:
-                self.conversations.append(msg)
-                self._save_to_file()
-            
-            self.conversations.append(msg)
-            self.save_memory()
-        except Exception as e:
-            print(f"[WARNING] Failed to add message: {e}")
-            self.conversations.append(msg)
-            self._save_to_file()
+                with open(self.summary_file, "wb") as f:
+                    f.write(_json_line({"summary": self.summary, "summary_upto": self.summary_upto}))
     
     def get_recent_context(self, max_messages: int = 15) -> str:
         """Get recent context for prompt"""
         if not self.conversations:
             return ""
         
-        context = "📝 LỊCH SỬ CUỘC TRÒ CHUYỆN GẦN ĐÂY:\n"
+        # History only grows between turns, so the message count identifies the rendered tail
+        key = (len(self.conversations), max_messages)
+        if self._context_cache and self._context_cache[:2] == key:
+            return self._context_cache[2]
+        
+        parts = []
+        if self.summary:
+            # Turns older than the quoted window are only present in condensed form
+            parts.append(f"🧾 TÓM TẮT CÁC CUỘC TRÒ CHUYỆN TRƯỚC:\n{self.summary}\n\n")
+        parts.append("📝 LỊCH SỬ CUỘC TRÒ CHUYỆN GẦN ĐÂY:\n")
         for msg in self.conversations[-max_messages:]:
             role = "👤 Bạn" if msg["role"] == "user" else "🤖 AI"
             content = msg["content"][:300]
-            context += f"{role}: {content}\n\n"
+            parts.append(f"{role}: {content}\n\n")
         
+        context = "".join(parts)
+        self._context_cache = (*key, context)
         return context
     
     def get_all_messages(self) -> List[Dict]:
         """Get all messages"""
         return self.conversations
 
-conversation_memories: Dict[str, ConversationMemory] = {}
+# Most recently used sessions last; evicted sessions are flushed, so eviction loses nothing
+conversation_memories: "OrderedDict[str, ConversationMemory]" = OrderedDict()
 
 async def get_memory(session_id: Optional[str]) -> ConversationMemory:
     """Get or create conversation memory for a session"""
-    if not session_id:
+    new_session = not session_id
+    if new_session:
         session_id = str(uuid.uuid4())
     
-    if session_id not in conversation_memories:
-        conversation_memories[session_id] = ConversationMemory(session_id)
+    memory = conversation_memories.get(session_id)
+    if memory is None:
+        # Loading runs DB queries or gzip reads, so keep it off the loop; a freshly generated id
+        # has no stored history, so its load is skipped entirely
+        loaded = await asyncio.to_thread(ConversationMemory, session_id, new_session=new_session)
+        # Another request for the same session may have finished loading while this one waited
+        memory = conversation_memories.setdefault(session_id, loaded)
+        conversation_memories.move_to_end(session_id)
+        if len(conversation_memories) > MEMORY_CACHE_SIZE:
+            _, evicted = conversation_memories.popitem(last=False)
+            await evicted.flush_async()
+    else:
+        conversation_memories.move_to_end(session_id)
     
-    return conversation_memories[session_id]
+    return memory
 
 # ==================== AI User Memory Functions ====================
 
@@ -414,11 +1149,24 @@ async def get_ai_memory_context(session_id: str) -> str:
     if not memories:
         return ""
     
-    context = "\n🧠 THÔNG TIN ĐÃ GHI NHỚ VỀ NGƯỜI DÙNG:\n"
-    for key, value in memories.items():
-        context += f"  • {key}: {value}\n"
-    context += "\n"
-    return context
+    parts = ["\n🧠 THÔNG TIN ĐÃ GHI NHỚ VỀ NGƯỜI DÙNG:\n"]
+    parts.extend(f"  • {key}: {value}\n" for key, value in memories.items())
+    parts.append("\n")
+    return "".join(parts)
+
+# Static framing around retrieved KB passages, rendered once at import
+KB_CONTEXT_HEADER = (
+    f"\n\n{SEP}"
+    "📚 TÀI LIỆU TỪ KHO DỮ LIỆU CỦA BẠN\n"
+    f"{SEP}"
+    "Bạn đã tải lên các tài liệu vào kho dữ liệu.\n"
+    "Đây là nội dung TEXT từ những tệp đó:\n\n"
+)
+KB_CONTEXT_FOOTER = (
+    f"{SEP}"
+    "⚠️ BẠN CÓ QUYỀN TRUY CẬP vào nội dung trên. Hãy sử dụng nó để trả lời!\n"
+    f"{SEP}\n"
+)
 
 async def get_kb_context(kb_name: Optional[str], user_query: str) -> str:
     """Build knowledge base context for AI"""
@@ -429,148 +1177,682 @@ async def get_kb_context(kb_name: Optional[str], user_query: str) -> str:
     if not kb or not kb.documents:
         return ""
     
-    relevant_docs = kb.query(user_query, top_k=3)
+    # Query embedding and search block, so run them off the event loop
+    relevant_docs = await asyncio.to_thread(kb.query, user_query, 3)
     if not relevant_docs:
         return ""
     
-    kb_context = "\n\n" + "="*80 + "\n"
-    kb_context += "📚 TÀI LIỆU TỪ KHO DỮ LIỆU CỦA BẠN\n"
-    kb_context += "="*80 + "\n"
-    kb_context += "Bạn đã tải lên các tài liệu vào kho dữ liệu.\n"
-    kb_context += "Đây là nội dung TEXT từ những tệp đó:\n\n"
-    
-    for i, doc in enumerate(relevant_docs, 1):
-        kb_context += f"--- TÀI LIỆU {i} ---\n"
-        kb_context += doc[:2000] + ("..." if len(doc) > 2000 else "") + "\n\n"
-    
-    kb_context += "="*80 + "\n"
-    kb_context += "⚠️ BẠN CÓ QUYỀN TRUY CẬP vào nội dung trên. Hãy sử dụng nó để trả lời!\n"
-    kb_context += "="*80 + "\n\n"
-    
-    return kb_context
-
-def build_conversation_context(history: List[Dict], max_messages: int = 10) -> str:
-    """Build conversation history context"""
+    # Results are already passage-sized (CHUNK_SIZE windows chosen at upload time), so no trimming here
+    parts = [KB_CONTEXT_HEADER]
+    parts.extend(f"--- TÀI LIỆU {i} ---\n{doc}\n\n" for i, doc in enumerate(relevant_docs, 1))
+    parts.append(KB_CONTEXT_FOOTER)
+    return "".join(parts)
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count without a tokenizer call"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def build_conversation_context(history: List[Dict], max_tokens: int = MAX_HISTORY_TOKENS) -> str:
+    """Build conversation history context from the newest messages that fit in max_tokens"""
     if not history:
         return ""
     
-    context = "📝 LỊCH SỬ CUỘC TRÒ CHUYỆN:\n"
-    for msg in history[-max_messages:]:
+    # Walk back from the newest message until the budget runs out, then restore chronological order
+    lines = []
+    budget = max_tokens
+    for msg in reversed(history):
         role = "👤 Bạn" if msg.get("role") == "user" else "🤖 AI"
         content = msg.get('content', '')[:500]  # Limit length
-        context += f"{role}: {content}\n\n"
+        line = f"{role}: {content}\n\n"
+        budget -= estimate_tokens(line)
+        if budget < 0:
+            break
+        lines.append(line)
     
-    return context
+    return "".join(["📝 LỊCH SỬ CUỘC TRÒ CHUYỆN:\n", *reversed(lines)])
+
+_CHUNK_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+def _chunk(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[tuple]:
+    """Split text into overlapping (start, end) character windows"""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            # Prefer the strongest boundary in the back half of the window: paragraph, line, sentence, word
+            for sep in _CHUNK_SEPARATORS:
+                cut = text.rfind(sep, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(sep)
+                    break
+        spans.append((start, end))
+        if end == len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return spans
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def _tokenize(text: str) -> List[str]:
+    """Lowercased word tokens for BM25"""
+    return _TOKEN_RE.findall(text.lower())
+
+def embed_texts(texts: List[str], task_type: str) -> np.ndarray:
+    """Embed texts with Gemini and return L2-normalized float32 rows"""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=[text[:EMBEDDING_MAX_CHARS] for text in texts],
+        task_type=task_type
+    )
+    vectors = np.asarray(result["embedding"], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def quantize(vectors: np.ndarray) -> np.ndarray:
+    """Scale L2-normalized float vectors to int8"""
+    return np.clip(np.round(vectors * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+
+def dequantize(vectors: np.ndarray) -> np.ndarray:
+    """Recover approximate float32 vectors from int8 rows"""
+    return vectors.astype(np.float32) / INT8_SCALE
+
+if NUMBA_AVAILABLE:
+    # No cache=True: numba refuses to decorate when it finds no writable cache dir, as in a read-only bundle
+    @numba.njit(parallel=True, fastmath=True)
+    def _int8_scores(embeddings, query_vec):
+        """Dot every int8 row with the query in one fused pass, without a float32 copy of the table"""
+        scores = np.empty(embeddings.shape[0], dtype=np.float32)
+        for i in numba.prange(embeddings.shape[0]):
+            acc = np.float32(0.0)
+            for j in range(embeddings.shape[1]):
+                acc += embeddings[i, j] * query_vec[j]
+            scores[i] = acc
+        return scores
+else:
+    def _int8_scores(embeddings: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
+        """Dot every int8 row with the query, dequantizing block by block to bound memory"""
+        return np.concatenate([
+            embeddings[start:start + SCAN_BLOCK_ROWS].astype(np.float32) @ query_vec
+            for start in range(0, len(embeddings), SCAN_BLOCK_ROWS)
+        ])
+
+def _top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting the whole array"""
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        rows = np.argpartition(-scores, k - 1)[:k]
+        return rows[np.argsort(-scores[rows])]
+    return np.argsort(-scores)
+
+class EmbeddingStore:
+    """SQLite cache of int8 document embeddings keyed by content hash, so a cold start never re-embeds"""
+    def __init__(self, path: str = KB_EMBEDDINGS_FILE):
+        self._lock = threading.Lock()
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Superseded by the int8 table below; it is only a cache, so drop it
+            self._conn.execute("DROP TABLE IF EXISTS document_embeddings")
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS document_embeddings_int8 (
+                    text_hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (text_hash, model)
+                )
+            ''')
+            self._conn.commit()
+        except Exception as e:
+            print(f"[WARNING] Embedding store unavailable, embeddings will not persist: {e}")
+            self._conn = None
+    
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Load stored vectors for the given content hashes"""
+        if self._conn is None or not hashes:
+            return {}
+        unique = list(dict.fromkeys(hashes))
+        found = {}
+        try:
+            with self._lock:
+                # Stay below SQLite's bound-parameter limit
+                for start in range(0, len(unique), 500):
+                    batch = unique[start:start + 500]
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, vector FROM document_embeddings_int8 WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                        [EMBEDDING_MODEL, *batch]
+                    ).fetchall()
+                    found.update((text_hash, np.frombuffer(blob, dtype=np.int8)) for text_hash, blob in rows)
+        except Exception as e:
+            print(f"[WARNING] Failed to read stored embeddings: {e}")
+        return found
+    
+    def put_many(self, vectors: Dict[str, np.ndarray]):
+        """Persist vectors by content hash"""
+        if self._conn is None or not vectors:
+            return
+        try:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO document_embeddings_int8 (text_hash, model, vector) VALUES (?, ?, ?)",
+                    [(text_hash, EMBEDDING_MODEL, vector.tobytes()) for text_hash, vector in vectors.items()]
+                )
+                self._conn.commit()
+        except Exception as e:
+            print(f"[WARNING] Failed to store embeddings: {e}")
+
+embedding_store = EmbeddingStore()
+
+def embed_documents(texts: List[str]) -> np.ndarray:
+    """Embed document texts as int8 rows, calling Gemini only for texts without a stored vector"""
+    hashes = [embedding_store.text_hash(text) for text in texts]
+    vectors = embedding_store.get_many(hashes)
+    missing = [i for i, text_hash in enumerate(hashes) if text_hash not in vectors]
+    if missing:
+        new_vectors = quantize(embed_texts([texts[i] for i in missing], "retrieval_document"))
+        fresh = {hashes[i]: vector for i, vector in zip(missing, new_vectors)}
+        embedding_store.put_many(fresh)
+        vectors.update(fresh)
+    return np.vstack([vectors[text_hash] for text_hash in hashes])
+
+def prefetch_embeddings(texts: List[str]):
+    """Embed the passages of documents about to be added, so adding them only hits the embedding store"""
+    try:
+        embed_documents([text[start:end] for text in texts for start, end in _chunk(text)])
+    except Exception as e:
+        # add_document retries and, failing that, embeds on the next query
+        print(f"[WARNING] Failed to prefetch embeddings: {e}")
+
+class QueryEmbeddingCache:
+    """LRU cache of query embeddings keyed by the BLAKE2b digest of the query text"""
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._vectors: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()  # Queries run in worker threads
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Return the query embedding, calling Gemini only on a cache miss"""
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is not None:
+                self._vectors.move_to_end(key)
+                return vector
+        vector = embed_texts([text], "retrieval_query")[0]
+        with self._lock:
+            self._vectors[key] = vector
+            if len(self._vectors) > self.maxsize:
+                self._vectors.popitem(last=False)
+        return vector
+
+query_embedding_cache = QueryEmbeddingCache()
 
 # Multi-Knowledge Base System
 class KnowledgeBase:
     """Single knowledge base instance"""
-    def __init__(self, name: str):
+    def __init__(self, name: str, store: Optional["KnowledgeBaseStore"] = None):
         self.name = name
-        self.documents = []  # List of dicts with {id, text, filename, uploaded_at}
+        self.store = store  # Persists every mutation as it happens; None keeps the KB in memory only
+        self.documents: Dict[int, Dict] = {}  # id -> {id, text, filename, uploaded_at}, in insertion order
         self.created_at = None
         self.next_id = 0
+        self._lock = threading.RLock()  # Held by mutations and searches, which may run in worker threads
+        self._reset_vectors()
+    
+    def _reset_vectors(self):
+        """Drop all chunk embeddings; they are rebuilt from the embedding store on the next query"""
+        # Vector store: one quantized, L2-normalized int8 row per document chunk
+        self.embeddings: Optional[np.ndarray] = None  # Leading rows of _embedding_buf
+        self._embedding_buf: Optional[np.ndarray] = None  # Preallocated storage with spare rows for appends
+        self.embedding_ids: List[Optional[int]] = []  # Parent document id for each row; None marks a removed chunk
+        self.chunk_spans: List[tuple] = []  # (start, end) of each row's passage within its parent text
+        self.chunk_tokens: List[List[str]] = []  # BM25 tokens of each row's passage
+        self._bm25 = None  # BM25Okapi over chunk_tokens, rebuilt lazily after changes
+        self._doc_rows: Dict[int, List[int]] = {}
+        self._unembedded = set(self.documents)  # Ids of documents whose passages have not been embedded yet
+        self._tombstones = 0
+        self._index = None  # faiss index, rebuilt lazily from self.embeddings
+        # Semantic result cache: (query vector, top_k, matching rows), newest last
+        self._result_cache: List[tuple] = []
+    
+    def __setstate__(self, state):
+        # Only used to import legacy pickles: older ones store documents as a list,
+        # and any stored vectors may predate chunking
+        if isinstance(state.get("documents"), list):
+            state["documents"] = {doc["id"]: doc for doc in state["documents"]}
+        state.pop("_id_to_row", None)
+        self.__dict__.update(state)
+        self.store = None
+        self._lock = threading.RLock()
+        self._reset_vectors()
     
     def add_document(self, text: str, filename: str = ""):
         """Add document to this knowledge base"""
-        doc = {
-            "id": self.next_id,
-            "text": text,
-            "filename": filename,
-            "uploaded_at": None  # Could add timestamp if needed
-        }
-        self.documents.append(doc)
-        self.next_id += 1
-        return doc["id"]
+        return self.add_documents_bulk([(text, filename)])[0]
+    
+    def add_documents_bulk(self, items: List[tuple]) -> List[int]:
+        """Add (text, filename) documents with one store write and one embedding batch; returns their ids"""
+        if not items:
+            return []
+        with self._lock:
+            # The store hands out ids so workers adding to the same KB never collide
+            if self.store:
+                doc_ids = self.store.insert_documents(self.name, items)
+            else:
+                doc_ids = list(range(self.next_id, self.next_id + len(items)))
+            docs = [
+                {
+                    "id": doc_id,
+                    "text": text,
+                    "filename": filename,
+                    "uploaded_at": None  # Could add timestamp if needed
+                }
+                for doc_id, (text, filename) in zip(doc_ids, items)
+            ]
+            for doc in docs:
+                self.documents[doc["id"]] = doc
+            self._unembedded.update(doc_ids)
+            self.next_id = max(self.next_id, doc_ids[-1] + 1)
+            try:
+                self._embed_documents(docs)
+            except Exception as e:
+                # The documents are still stored; they get embedded on the next query
+                print(f"[WARNING] Failed to embed {len(docs)} document(s): {e}")
+        return doc_ids
+    
+    def _embed_documents(self, docs: List[Dict]):
+        """Split documents into passages and add one embedding row per passage"""
+        doc_ids, spans = [], []
+        for doc in docs:
+            for span in _chunk(doc["text"]):
+                doc_ids.append(doc["id"])
+                spans.append(span)
+        if spans:
+            texts = [self.documents[doc_id]["text"][start:end] for doc_id, (start, end) in zip(doc_ids, spans)]
+            self._add_embeddings(doc_ids, spans, embed_documents(texts))
+        self._unembedded.difference_update(doc["id"] for doc in docs)
+    
+    def _add_embeddings(self, doc_ids: List[int], spans: List[tuple], vectors: np.ndarray):
+        """Append embedding rows and keep the ANN index in sync"""
+        rows, added = len(self.embedding_ids), len(vectors)
+        if self._embedding_buf is None or rows + added > len(self._embedding_buf):
+            # Grow geometrically so a stream of small uploads copies the table O(log N) times, not once per upload
+            buf = np.empty((max(EMBEDDING_MIN_CAPACITY, 2 * (rows + added)), vectors.shape[1]), dtype=vectors.dtype)
+            if rows:
+                buf[:rows] = self.embeddings
+            self._embedding_buf = buf
+        self._embedding_buf[rows:rows + added] = vectors
+        self.embeddings = self._embedding_buf[:rows + added]
+        for doc_id, (start, end) in zip(doc_ids, spans):
+            self._doc_rows.setdefault(doc_id, []).append(len(self.embedding_ids))
+            self.embedding_ids.append(doc_id)
+            self.chunk_spans.append((start, end))
+            self.chunk_tokens.append(_tokenize(self.documents[doc_id]["text"][start:end]))
+        self._bm25 = None
+        self._result_cache = []
+        if self._index is not None:
+            self._index.add(dequantize(vectors))
+    
+    def _ensure_embeddings(self):
+        """Load or embed vectors for documents that have none (e.g. after loading from disk)"""
+        if self._unembedded:
+            self._embed_documents([self.documents[doc_id] for doc_id in sorted(self._unembedded)])
+    
+    def _compact(self):
+        """Drop tombstoned embedding rows once they make up half of the table"""
+        live_rows = [row for row, doc_id in enumerate(self.embedding_ids) if doc_id is not None]
+        self.embeddings = self._embedding_buf = self.embeddings[live_rows] if live_rows else None
+        self.embedding_ids = [self.embedding_ids[row] for row in live_rows]
+        self.chunk_spans = [self.chunk_spans[row] for row in live_rows]
+        self.chunk_tokens = [self.chunk_tokens[row] for row in live_rows]
+        self._bm25 = None
+        self._doc_rows = {}
+        for row, doc_id in enumerate(self.embedding_ids):
+            self._doc_rows.setdefault(doc_id, []).append(row)
+        self._tombstones = 0
+        self._index = None
+    
+    def _get_index(self):
+        """Build the faiss HNSW index with 8-bit scalar-quantized storage once the KB is large enough"""
+        if (self._index is None and FAISS_AVAILABLE and self.embeddings is not None
+                and len(self.embedding_ids) >= HNSW_MIN_DOCUMENTS):
+            vectors = dequantize(self.embeddings)
+            dim = vectors.shape[1]
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit_uniform, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            # Train on the full [-1, 1] range so vectors added later are never clipped
+            index.train(np.vstack([np.ones((1, dim), np.float32), -np.ones((1, dim), np.float32)]))
+            index.add(vectors)
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+            self._index = index
+        return self._index
+    
+    def _search(self, query_vec: np.ndarray, top_k: int) -> List[int]:
+        """Return embedding row numbers of the top_k nearest passages"""
+        # Reuse the result of a near-identical earlier query
+        for cached_vec, cached_k, cached_rows in reversed(self._result_cache):
+            if cached_k == top_k and float(cached_vec @ query_vec) >= SEMANTIC_CACHE_THRESHOLD:
+                return cached_rows
+        rows = self._search_index(query_vec, top_k)
+        self._result_cache.append((query_vec, top_k, rows))
+        if len(self._result_cache) > RESULT_CACHE_SIZE:
+            self._result_cache.pop(0)
+        return rows
+    
+    def _search_index(self, query_vec: np.ndarray, top_k: int) -> List[int]:
+        """Nearest-neighbor lookup against the faiss index or a NumPy scan"""
+        if self.embeddings is None:
+            return []
+        # Over-fetch by the number of tombstones so removed rows can be skipped
+        k = min(top_k + self._tombstones, len(self.embedding_ids))
+        index = self._get_index()
+        if index is not None:
+            _, rows = index.search(query_vec.reshape(1, -1), k)
+            rows = [int(row) for row in rows[0] if row >= 0]
+        else:
+            scores = _int8_scores(self.embeddings, np.ascontiguousarray(query_vec, dtype=np.float32))
+            rows = [int(row) for row in _top_k_rows(scores, k)]
+        return [row for row in rows if self.embedding_ids[row] is not None][:top_k]
+    
+    def _search_bm25(self, query_text: str, top_k: int) -> List[int]:
+        """Return embedding row numbers of the top_k passages by BM25 keyword score"""
+        if not BM25_AVAILABLE or not self.chunk_tokens:
+            return []
+        tokens = _tokenize(query_text)
+        if not tokens:
+            return []
+        if self._bm25 is None:
+            # BM25Okapi rejects an empty corpus, which an all-tombstone table would be
+            self._bm25 = BM25Okapi([row_tokens or [""] for row_tokens in self.chunk_tokens])
+        scores = self._bm25.get_scores(tokens)
+        rows = _top_k_rows(scores, top_k)
+        return [int(row) for row in rows if scores[row] > 0 and self.embedding_ids[row] is not None]
+    
+    def _hybrid_search(self, query_text: str, query_vec: np.ndarray, top_k: int) -> List[int]:
+        """Fuse vector and BM25 rankings with reciprocal-rank fusion"""
+        candidates = max(top_k, HYBRID_CANDIDATES)
+        scores: Dict[int, float] = {}
+        # Unweighted, so a BM25-only top hit (e.g. an exact model number) ties the best vector-only hit
+        for rows in (self._search(query_vec, candidates), self._search_bm25(query_text, candidates)):
+            for rank, row in enumerate(rows, 1):
+                scores[row] = scores.get(row, 0.0) + 1.0 / (RRF_K + rank)
+        return sorted(scores, key=scores.get, reverse=True)[:top_k]
     
     def remove_document(self, doc_id: int) -> bool:
         """Remove a document by ID"""
-        for i, doc in enumerate(self.documents):
-            if doc["id"] == doc_id:
-                self.documents.pop(i)
-                return True
-        return False
+        with self._lock:
+            if doc_id in self.documents and self.store:
+                self.store.delete_document(self.name, doc_id)
+            return self._remove_document(doc_id)
+    
+    def _remove_document(self, doc_id: int) -> bool:
+        if self.documents.pop(doc_id, None) is None:
+            return False
+        self._unembedded.discard(doc_id)
+        rows = self._doc_rows.pop(doc_id, [])
+        if rows:
+            for row in rows:
+                self.embedding_ids[row] = None
+                self.chunk_tokens[row] = []
+            self._tombstones += len(rows)
+            self._bm25 = None
+            self._result_cache = []
+            if self._tombstones * 2 > len(self.embedding_ids):
+                self._compact()
+        return True
     
     def get_document(self, doc_id: int):
         """Get a document by ID"""
-        for doc in self.documents:
-            if doc["id"] == doc_id:
-                return doc
-        return None
+        return self.documents.get(doc_id)
+    
+    def _opening_passages(self, top_k: int, error: Exception) -> List[str]:
+        """Without embeddings fall back to the opening passage of the first documents"""
+        print(f"[WARNING] Semantic search unavailable for KB {self.name}: {error}")
+        with self._lock:
+            return [doc["text"][:CHUNK_SIZE] for doc in islice(self.documents.values(), top_k)]
     
     def query(self, query_text: str, top_k: int = 3) -> List[str]:
-        """Retrieve relevant documents from this KB"""
-        # Simple approach: return top_k documents
-        # In production, use proper embeddings and semantic search
+        """Retrieve the top_k passages best matching the query, merged per source document"""
         if not self.documents:
             return []
-        return [doc["text"] for doc in self.documents[:min(top_k, len(self.documents))]]
+        try:
+            # Embed outside the lock so concurrent queries do not wait on each other's Gemini round trip
+            query_vec = query_embedding_cache.embed(query_text)
+        except Exception as e:
+            return self._opening_passages(top_k, e)
+        with self._lock:
+            try:
+                self._ensure_embeddings()
+            except Exception as e:
+                return self._opening_passages(top_k, e)
+            
+            # Group passages by parent document, in order of each document's best match
+            doc_spans: Dict[int, List[tuple]] = {}
+            for row in self._hybrid_search(query_text, query_vec, top_k):
+                doc_spans.setdefault(self.embedding_ids[row], []).append(self.chunk_spans[row])
+            texts = {doc_id: self.documents[doc_id]["text"] for doc_id in doc_spans}
+        
+        results = []
+        for doc_id, spans in doc_spans.items():
+            # Merge overlapping windows so shared text is not repeated
+            merged = []
+            for start, end in sorted(spans):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            text = texts[doc_id]
+            results.append("\n...\n".join(text[start:end] for start, end in merged))
+        return results
     
     def clear(self):
         """Clear all documents from this knowledge base"""
-        self.documents = []
-        self.next_id = 0
+        with self._lock:
+            if self.store:
+                self.store.clear_kb(self.name)
+            self.documents = {}
+            self.next_id = 0
+            self._reset_vectors()
+
+_RECOUNT_KB_DOCS_SQL = "UPDATE kbs SET doc_count = (SELECT COUNT(*) FROM kb_docs WHERE kb_docs.kb_name = kbs.name)"
+
+class KnowledgeBaseStore:
+    """SQLite persistence for knowledge bases: one row per KB and per document, shared by all workers"""
+    def __init__(self, path: str = KB_STORAGE_FILE):
+        self._lock = threading.Lock()
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = self._open(path)
+        except Exception as e:
+            # Keep the API up (e.g. on a read-only filesystem); KBs then last only as long as this worker
+            print(f"[WARNING] Knowledge base store unavailable at {path}, knowledge bases will not persist: {e}")
+            self._conn = self._open(":memory:")
+    
+    @staticmethod
+    def _open(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS kbs (
+                name TEXT PRIMARY KEY,
+                next_id INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT,
+                doc_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS kb_docs (
+                kb_name TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                filename TEXT,
+                text TEXT NOT NULL,
+                uploaded_at TEXT,
+                PRIMARY KEY (kb_name, doc_id)
+            );
+        ''')
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(kbs)")]
+        if "doc_count" not in columns:
+            # Stores created before the counter existed: add it and backfill once
+            conn.execute("ALTER TABLE kbs ADD COLUMN doc_count INTEGER NOT NULL DEFAULT 0")
+            conn.execute(_RECOUNT_KB_DOCS_SQL)
+        conn.commit()
+        return conn
+    
+    def data_version(self) -> int:
+        """Changes whenever another connection (i.e. another worker) commits"""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def list_kbs(self) -> List[tuple]:
+        """(name, document_count) for every KB, in creation order"""
+        with self._lock:
+            return self._conn.execute("SELECT name, doc_count FROM kbs ORDER BY rowid").fetchall()
+    
+    def load_kb(self, name: str) -> Optional[KnowledgeBase]:
+        """Read one KB and its documents"""
+        with self._lock:
+            row = self._conn.execute("SELECT next_id, created_at FROM kbs WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            docs = self._conn.execute(
+                "SELECT doc_id, filename, text, uploaded_at FROM kb_docs WHERE kb_name = ? ORDER BY doc_id", (name,)
+            ).fetchall()
+        kb = KnowledgeBase(name, store=self)
+        kb.next_id, kb.created_at = row
+        kb.documents = {
+            doc_id: {"id": doc_id, "text": text, "filename": filename, "uploaded_at": uploaded_at}
+            for doc_id, filename, text, uploaded_at in docs
+        }
+        kb._reset_vectors()
+        return kb
+    
+    def create_kb(self, name: str, next_id: int = 0, created_at: Optional[str] = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO kbs (name, next_id, created_at) VALUES (?, ?, ?)", (name, next_id, created_at)
+            )
+    
+    def delete_kb(self, name: str) -> bool:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kb_docs WHERE kb_name = ?", (name,))
+            return self._conn.execute("DELETE FROM kbs WHERE name = ?", (name,)).rowcount > 0
+    
+    def delete_all(self) -> int:
+        """Drop every KB and document in one transaction; returns the number of KBs removed"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kb_docs")
+            return self._conn.execute("DELETE FROM kbs").rowcount
+    
+    def insert_documents(self, kb_name: str, items: List[tuple]) -> List[int]:
+        """Store (text, filename) documents in one transaction and return their newly allocated ids"""
+        with self._lock, self._conn:
+            # Bumping next_id first takes SQLite's write lock, so the ids are unique across workers
+            if self._conn.execute(
+                "UPDATE kbs SET next_id = next_id + ?, doc_count = doc_count + ? WHERE name = ?",
+                (len(items), len(items), kb_name)
+            ).rowcount == 0:
+                raise ValueError(f"Knowledge base '{kb_name}' no longer exists")
+            first_id = self._conn.execute("SELECT next_id - ? FROM kbs WHERE name = ?", (len(items), kb_name)).fetchone()[0]
+            doc_ids = list(range(first_id, first_id + len(items)))
+            self._conn.executemany(
+                "INSERT INTO kb_docs (kb_name, doc_id, filename, text) VALUES (?, ?, ?, ?)",
+                [(kb_name, doc_id, filename, text) for doc_id, (text, filename) in zip(doc_ids, items)]
+            )
+        return doc_ids
+    
+    def delete_document(self, kb_name: str, doc_id: int):
+        with self._lock, self._conn:
+            if self._conn.execute("DELETE FROM kb_docs WHERE kb_name = ? AND doc_id = ?", (kb_name, doc_id)).rowcount:
+                self._conn.execute("UPDATE kbs SET doc_count = doc_count - 1 WHERE name = ?", (kb_name,))
+    
+    def clear_kb(self, kb_name: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kb_docs WHERE kb_name = ?", (kb_name,))
+            self._conn.execute("UPDATE kbs SET next_id = 0, doc_count = 0 WHERE name = ?", (kb_name,))
+    
+    def import_kb(self, kb: KnowledgeBase):
+        """Copy an in-memory KB (e.g. from a legacy pickle) into the store, keeping its ids"""
+        # Some old pickles never advanced next_id, so derive it from the ids actually in use
+        next_id = max([kb.next_id] + [doc_id + 1 for doc_id in kb.documents])
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO kbs (name, next_id, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET next_id = MAX(next_id, excluded.next_id)",
+                (kb.name, next_id, kb.created_at)
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO kb_docs (kb_name, doc_id, filename, text, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                [(kb.name, doc["id"], doc["filename"], doc["text"], doc["uploaded_at"]) for doc in kb.documents.values()]
+            )
+            self._conn.execute(_RECOUNT_KB_DOCS_SQL + " WHERE name = ?", (kb.name,))
 
 class KnowledgeBaseManager:
-    """Manage multiple knowledge bases"""
-    KB_STORAGE_FILE = "kb_storage.pkl"
-    
+    """Manage multiple knowledge bases backed by KnowledgeBaseStore; KBs are loaded on first use"""
     def __init__(self):
-        self.knowledge_bases: Dict[str, KnowledgeBase] = {}
-        self.load_from_disk()
+        self.store = KnowledgeBaseStore()
+        self.knowledge_bases: Dict[str, KnowledgeBase] = {}  # KBs loaded so far
+        self._data_version: Optional[int] = None
+        self._import_legacy_pickle()
     
-    def save_to_disk(self):
-        """Save all KBs to disk"""
+    def _import_legacy_pickle(self):
+        """One-time import of the pickle file written by earlier versions"""
+        legacy_file = Path(LEGACY_KB_PICKLE_FILE)
+        if not legacy_file.exists():
+            return
         try:
-            with open(self.KB_STORAGE_FILE, "wb") as f:
-                pickle.dump(self.knowledge_bases, f)
-            print(f"[INFO] Saved {len(self.knowledge_bases)} KBs to disk")
+            with open(legacy_file, "rb") as f:
+                legacy_kbs = pickle.load(f)
+            for kb in legacy_kbs.values():
+                self.store.import_kb(kb)
+            legacy_file.rename(legacy_file.with_name(legacy_file.name + ".migrated"))
+            print(f"[INFO] Imported {len(legacy_kbs)} KBs from {LEGACY_KB_PICKLE_FILE}")
         except Exception as e:
-            print(f"[ERROR] Failed to save KBs: {e}")
+            print(f"[ERROR] Failed to import legacy KB storage: {e}")
     
-    def load_from_disk(self):
-        """Load KBs from disk"""
-        try:
-            if Path(self.KB_STORAGE_FILE).exists():
-                with open(self.KB_STORAGE_FILE, "rb") as f:
-                    self.knowledge_bases = pickle.load(f)
-                print(f"[INFO] Loaded {len(self.knowledge_bases)} KBs from disk")
-            else:
-                print("[INFO] No KB storage file found, starting fresh")
-        except Exception as e:
-            print(f"[ERROR] Failed to load KBs: {e}")
+    def refresh(self):
+        """Drop loaded KBs if another worker has written to the store since we last looked"""
+        version = self.store.data_version()
+        if version != self._data_version:
             self.knowledge_bases = {}
+            self._data_version = version
     
     def create_kb(self, name: str) -> KnowledgeBase:
         """Create new knowledge base"""
-        if name in self.knowledge_bases:
-            return self.knowledge_bases[name]
-        kb = KnowledgeBase(name)
-        self.knowledge_bases[name] = kb
-        self.save_to_disk()
-        return kb
+        self.store.create_kb(name)
+        return self.get_kb(name)
     
     def get_kb(self, name: str) -> Optional[KnowledgeBase]:
         """Get knowledge base by name"""
-        return self.knowledge_bases.get(name)
+        self.refresh()
+        kb = self.knowledge_bases.get(name)
+        if kb is None:
+            kb = self.store.load_kb(name)
+            if kb is not None:
+                self.knowledge_bases[name] = kb
+        return kb
     
     def list_kbs(self) -> List[dict]:
         """List all knowledge bases"""
         return [
             {
                 "name": name,
-                "document_count": len(kb.documents)
+                "document_count": document_count
             }
-            for name, kb in self.knowledge_bases.items()
+            for name, document_count in self.store.list_kbs()
         ]
     
     def delete_kb(self, name: str) -> bool:
         """Delete knowledge base"""
-        if name in self.knowledge_bases:
-            del self.knowledge_bases[name]
-            self.save_to_disk()
-            return True
-        return False
+        self.knowledge_bases.pop(name, None)
+        return self.store.delete_kb(name)
+    
+    def delete_all(self) -> int:
+        """Delete every knowledge base"""
+        self.knowledge_bases = {}
+        return self.store.delete_all()
 
 # Initialize knowledge base manager
 kb_manager = KnowledgeBaseManager()
@@ -596,28 +1878,20 @@ async def root():
     }
 
 @app.post("/api/study-buddy")
-async def study_buddy(files: List[UploadFile] = File(None), request: str = Form(None)):
+async def study_buddy(files: List[UploadFile] = File(None), form: ChatForm = Depends(parse_form)):
     """
     Summarize and explain content - Vietnamese optimized
     """
     try:
         text = ""
         kb_name = None
+        stream = False
         
         if files and len(files) > 0 and files[0] and files[0].filename:
-            file_texts = []
-            for file in files:
-                if file and file.filename:
-                    file_text = await extract_text_from_file(file)
-                    file_texts.append(file_text)
-            text = "\n\n".join(file_texts)
-        elif request:
-            try:
-                request_data = json.loads(request)
-                text = request_data.get("text", "")
-                kb_name = request_data.get("knowledge_base")
-            except:
-                text = request
+            file_texts = await extract_texts_from_files(files)
+            text = "\n\n".join(file_text for _, file_text in file_texts)
+        else:
+            text, kb_name, stream = form.text, form.knowledge_base, form.stream
         
         if not text:
             raise HTTPException(status_code=400, detail="Vui lòng cung cấp nội dung hoặc tải lên tệp")
@@ -640,8 +1914,13 @@ YÊUẨU ĐỊNH DẠNG TÓM TẮT:
 
 Hãy trả lời bằng tiếng Việt rõ ràng, dễ hiểu:"""
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
+        if stream:
+            async def done(_: str) -> Dict:
+                return {"success": True, "has_kb": bool(kb_context)}
+            
+            return gemini_event_stream(gemini_model, prompt, done)
+        
+        response = await gemini_dispatcher.submit(gemini_model, prompt)
         
         return {
             "success": True,
@@ -655,28 +1934,20 @@ Hãy trả lời bằng tiếng Việt rõ ràng, dễ hiểu:"""
         raise HTTPException(status_code=500, detail=f"Lỗi tóm tắt: {str(e)}")
 
 @app.post("/api/polisher")
-async def polisher(files: List[UploadFile] = File(None), request: str = Form(None)):
+async def polisher(files: List[UploadFile] = File(None), form: ChatForm = Depends(parse_form)):
     """
     Improve text for professional/academic use - Vietnamese optimized
     """
     try:
         text = ""
         kb_name = None
+        stream = False
         
         if files and len(files) > 0 and files[0] and files[0].filename:
-            file_texts = []
-            for file in files:
-                if file and file.filename:
-                    file_text = await extract_text_from_file(file)
-                    file_texts.append(file_text)
-            text = "\n\n".join(file_texts)
-        elif request:
-            try:
-                request_data = json.loads(request)
-                text = request_data.get("text", "")
-                kb_name = request_data.get("knowledge_base")
-            except:
-                text = request
+            file_texts = await extract_texts_from_files(files)
+            text = "\n\n".join(file_text for _, file_text in file_texts)
+        else:
+            text, kb_name, stream = form.text, form.knowledge_base, form.stream
         
         if not text:
             raise HTTPException(status_code=400, detail="Vui lòng cung cấp nội dung hoặc tải lên tệp")
@@ -701,8 +1972,13 @@ HƯỚNG DẪN:
 
 Hãy viết lại bản văn nâng cao:"""
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
+        if stream:
+            async def done(_: str) -> Dict:
+                return {"success": True, "original": text, "has_kb": bool(kb_context)}
+            
+            return gemini_event_stream(gemini_model, prompt, done)
+        
+        response = await gemini_dispatcher.submit(gemini_model, prompt)
         
         return {
             "success": True,
@@ -717,7 +1993,7 @@ Hãy viết lại bản văn nâng cao:"""
         raise HTTPException(status_code=500, detail=f"Lỗi trau chuốt: {str(e)}")
 
 @app.post("/api/fact-check")
-async def fact_check(files: List[UploadFile] = File(None), request: str = Form(None)):
+async def fact_check(files: List[UploadFile] = File(None), form: ChatForm = Depends(parse_form)):
     """
     Verify information using Gemini with Google Search Grounding
     """
@@ -726,28 +2002,16 @@ async def fact_check(files: List[UploadFile] = File(None), request: str = Form(N
         text = ""
         if files and len(files) > 0 and files[0] and files[0].filename:
             # Process multiple files
-            file_texts = []
-            for file in files:
-                if file and file.filename:
-                    file_text = await extract_text_from_file(file)
-                    file_texts.append(f"--- {file.filename} ---\n{file_text}")
-            text = "\n\n".join(file_texts)
-        elif request:
-            # Parse JSON string if it's a stringified object
-            try:
-                import json
-                request_data = json.loads(request)
-                text = request_data.get("text", "")
-            except:
-                text = request
+            file_texts = await extract_texts_from_files(files)
+            text = "\n\n".join(f"--- {filename} ---\n{file_text}" for filename, file_text in file_texts)
+        elif form.text:
+            text = form.text
         else:
             raise HTTPException(status_code=400, detail="Please provide text or upload files")
         
         # Use Gemini with Google Search grounding
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            tools='google_search_retrieval'
-        )
+        if gemini_search_model is None:
+            raise RuntimeError("Google Search grounding is not available")
         
         prompt = f"""🔎 Hãy KIỂM CHỨNG độ chính xác của phát biểu sau (trả lời bằng TIẾNG VIỆT).
     YÊU CẦU:
@@ -760,7 +2024,7 @@ async def fact_check(files: List[UploadFile] = File(None), request: str = Form(N
 
     Phân tích kiểm chứng:"""
         
-        response = model.generate_content(prompt)
+        response = await gemini_generate(gemini_search_model, prompt)
         
         return {
             "success": True,
@@ -770,8 +2034,6 @@ async def fact_check(files: List[UploadFile] = File(None), request: str = Form(N
     except Exception as e:
         # Fallback if search grounding is not available
         try:
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
             prompt = f"""Hãy phân tích độ chính xác của phát biểu sau (tiếng Việt). 
 Lưu ý: đây là phân tích dựa trên kiến thức mô hình, KHÔNG phải tìm kiếm thời gian thực.
 
@@ -780,7 +2042,7 @@ Phát biểu:
 
 Phân tích:"""
             
-            response = model.generate_content(prompt)
+            response = await gemini_generate(gemini_model, prompt)
             
             return {
                 "success": True,
@@ -791,8 +2053,40 @@ Phân tích:"""
         except Exception as fallback_error:
             raise HTTPException(status_code=500, detail=f"Error fact-checking: {str(fallback_error)}")
 
+# Fixed prompt text for /api/chat and /api/personal-doctor; handlers only fill in the slots
+CHAT_PROMPT_TEMPLATE = """Bạn là một trợ lý AI thông minh, tử tế và có khả năng thấu hiểu.
+
+HƯỚNG DẪN QUAN TRỌNG:
+1. 🗣️ Luôn trả lời bằng TIẾNG VIỆT tự nhiên và dễ hiểu
+2. 💭 Thấu hiểu ý định của người dùng, hỏi làm rõ nếu cần
+3. 📚 Nếu có KHO DỮ LIỆU, hãy ưu tiên sử dụng nó để trả lời
+4. 🧠 GHI NHỚ: Bạn có bộ nhớ liên tục từ các cuộc trò chuyện trước
+5. ❌ KHÔNG nói "Tôi không thể truy cập" - bạn CÓ các tệp ở trên!
+6. 📝 Trả lời súc tích nhưng đầy đủ thông tin
+
+{user_message}
+
+Trả lời của bạn:"""
+
+PERSONAL_DOCTOR_PROMPT_TEMPLATE = """Bạn là trợ lý sức khỏe & dinh dưỡng (trả lời TIẾNG VIỆT), đưa ra gợi ý dựa trên bằng chứng.
+    HƯỚNG DẪN:
+    - Nhấn mạnh: vấn đề nghiêm trọng cần bác sĩ thăm khám trực tiếp.
+    - Đưa lời khuyên phòng ngừa, lối sống, dinh dưỡng, vận động, giấc ngủ, tinh thần.
+    - Đồng cảm, tránh chẩn đoán chắc chắn; gợi ý gặp chuyên gia khi cần.
+    - Đưa khuyến nghị cụ thể, dễ làm; ưu tiên an toàn.
+    {kb_context}
+
+    Thông tin/ câu hỏi của người dùng:
+    {text_content}
+
+    Vui lòng đưa ra tư vấn ngắn gọn, dễ hiểu, có gạch đầu dòng nếu cần."""
+
 @app.post("/api/chat")
-async def chat(files: List[UploadFile] = File(None), request: str = Form(None)):
+async def chat(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(None),
+    form: ChatForm = Depends(parse_form),
+):
     """
     General chat conversation with persistent memory:
     - Persistent conversation memory per user
@@ -801,55 +2095,32 @@ async def chat(files: List[UploadFile] = File(None), request: str = Form(None)):
     - Semantic memory extraction
     """
     try:
-        # Parse request safely
-        text = ""
-        history = []
-        kb_name = None
-        session_id = None
-        
-        if request:
-            try:
-                request_data = json.loads(request)
-                text = request_data.get("text", "").strip()
-                history = request_data.get("history", [])
-                kb_name = request_data.get("knowledge_base")
-                session_id = request_data.get("session_id")
-            except Exception as parse_error:
-                text = request.strip()
-                print(f"[WARNING] Failed to parse chat request JSON, using raw text. Error: {parse_error}")
-        
-        # Get or create persistent memory for this session
-        memory = await get_memory(session_id)
+        text = form.text.strip()
+        history = form.history
+        kb_name = form.knowledge_base
+        session_id = form.session_id
+        stream = form.stream
+        
+        has_files = bool(files and files[0] and files[0].filename)
+        if not text and not has_files:
+            raise HTTPException(status_code=400, detail="Vui lòng nhập tin nhắn hoặc tải lên tệp")
         
-        # Process uploaded files
-        file_context = ""
-        if files and len(files) > 0 and files[0] and files[0].filename:
-            file_texts = []
-            for file in files:
-                if file and file.filename:
-                    file_text = await extract_text_from_file(file)
-                    file_texts.append(f"📄 Tệp '{file.filename}':\n{file_text}")
-            file_context = "\n\n".join(file_texts)
+        # Loading memory, extracting uploads and searching the KB are independent; run them together
+        memory, file_texts, kb_context = await asyncio.gather(
+            get_memory(session_id),
+            extract_texts_from_files(files if has_files else None),
+            get_kb_context(kb_name, text),
+        )
+        file_context = "\n\n".join(f"📄 Tệp '{filename}':\n{file_text}" for filename, file_text in file_texts)
         
         if not text and not file_context:
             raise HTTPException(status_code=400, detail="Vui lòng nhập tin nhắn hoặc tải lên tệp")
         
         # Build context - use persistent memory + recent history
-        conversation_context = build_conversation_context(history, max_messages=12)
-        persistent_context = memory.get_recent_context(max_messages=10)
-        kb_context = await get_kb_context(kb_name, text)
+        conversation_context = build_conversation_context(history)
+        persistent_context = memory.get_recent_context(max_messages=RECENT_CONTEXT_MESSAGES)
         
         # Build improved prompt with Vietnamese support and persistent memory
-        system_prompt = """Bạn là một trợ lý AI thông minh, tử tế và có khả năng thấu hiểu.
-
-HƯỚNG DẪN QUAN TRỌNG:
-1. 🗣️ Luôn trả lời bằng TIẾNG VIỆT tự nhiên và dễ hiểu
-2. 💭 Thấu hiểu ý định của người dùng, hỏi làm rõ nếu cần
-3. 📚 Nếu có KHO DỮ LIỆU, hãy ưu tiên sử dụng nó để trả lời
-4. 🧠 GHI NHỚ: Bạn có bộ nhớ liên tục từ các cuộc trò chuyện trước
-5. ❌ KHÔNG nói "Tôi không thể truy cập" - bạn CÓ các tệp ở trên!
-6. 📝 Trả lời súc tích nhưng đầy đủ thông tin"""
-        
         user_message = f"""Tin nhắn của người dùng: {text}"""
         
         if file_context:
@@ -860,25 +2131,30 @@ HƯỚNG DẪN QUAN TRỌNG:
         
         # Combine memory contexts - persistent first, then recent
         if persistent_context or conversation_context:
-            memory_section = ""
-            if persistent_context:
-                memory_section += persistent_context
-            if conversation_context:
-                memory_section += conversation_context
+            memory_section = persistent_context + conversation_context
             user_message = f"{memory_section}\n{user_message}"
         
-        full_prompt = f"""{system_prompt}
-
-{user_message}
-
-Trả lời của bạn:"""
+        full_prompt = CHAT_PROMPT_TEMPLATE.format(user_message=user_message)
+        
+        if stream:
+            async def save_turn(answer: str) -> Dict:
+                # Save to persistent memory once the full answer has been streamed
+                await memory.add_messages_async([("user", text), ("assistant", answer)], kb_name)
+                return {
+                    "success": True,
+                    "has_kb": bool(kb_context),
+                    "has_files": bool(file_context),
+                    "session_id": memory.user_id,
+                    "memory_messages": len(memory.conversations)
+                }
+            
+            return gemini_event_stream(gemini_model, full_prompt, save_turn)
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(full_prompt)
+        response = await gemini_generate(gemini_model, full_prompt)
         
-        # Save to persistent memory
-        memory.add_message("user", text, kb_name)
-        memory.add_message("assistant", response.text, kb_name)
+        # Save to persistent memory after the response has been sent
+        turn = [("user", text), ("assistant", response.text)]
+        background_tasks.add_task(memory.add_messages_async, turn, kb_name)
         
         return {
             "success": True,
@@ -886,13 +2162,12 @@ Trả lời của bạn:"""
             "has_kb": bool(kb_context),
             "has_files": bool(file_context),
             "session_id": memory.user_id,
-            "memory_messages": len(memory.conversations)
+            "memory_messages": len(memory.conversations) + len(turn)
         }
     
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
         print(f"[ERROR] Chat endpoint: {str(e)}")
         print(traceback.format_exc())
         return JSONResponse(
@@ -903,27 +2178,21 @@ Trả lời của bạn:"""
 @app.post("/api/personal-doctor")
 async def personal_doctor(
     files: List[UploadFile] = File(None),
-    request: str = Form(None),
+    form: ChatForm = Depends(parse_form),
 ):
     """Personal doctor endpoint - provide health advice and recommendations"""
     try:
         text_content = ""
-        kb_name = None
+        kb_name = form.knowledge_base
         
         # Process uploaded files
         if files and len(files) > 0 and files[0] and files[0].filename:
-            for file in files:
-                extracted = await extract_text_from_file(file)
+            for filename, extracted in await extract_texts_from_files(files):
                 if extracted:
-                    text_content += f"\n[From {file.filename}]\n{extracted}\n"
+                    text_content += f"\n[From {filename}]\n{extracted}\n"
         
-        # Parse request JSON
-        if request:
-            request_data = json.loads(request)
-            user_text = request_data.get("text", "")
-            kb_name = request_data.get("knowledge_base")
-            if user_text:
-                text_content += user_text
+        if form.text:
+            text_content += form.text
         
         if not text_content.strip():
             raise HTTPException(status_code=400, detail="Please provide health information")
@@ -933,30 +2202,26 @@ async def personal_doctor(
         if kb_name:
             kb = kb_manager.get_kb(kb_name)
             if kb and kb.documents:
-                relevant_docs = kb.query(text_content, top_k=3)
+                relevant_docs = await asyncio.to_thread(kb.query, text_content, 3)
                 if relevant_docs:
-                    kb_context = "\n\n=== MEDICAL REFERENCE MATERIALS FROM KNOWLEDGE BASE ===\n"
-                    kb_context += "Use these medical documents as reference for your advice:\n\n"
-                    for i, doc in enumerate(relevant_docs, 1):
-                        kb_context += f"--- Medical Reference {i} ---\n{doc}\n\n"
-                    kb_context += "=== END OF MEDICAL REFERENCES ===\n\n"
+                    parts = [
+                        "\n\n=== MEDICAL REFERENCE MATERIALS FROM KNOWLEDGE BASE ===\n",
+                        "Use these medical documents as reference for your advice:\n\n",
+                    ]
+                    parts.extend(f"--- Medical Reference {i} ---\n{doc}\n\n" for i, doc in enumerate(relevant_docs, 1))
+                    parts.append("=== END OF MEDICAL REFERENCES ===\n\n")
+                    kb_context = "".join(parts)
         
         # Create prompt for personal doctor AI
-        prompt = f"""Bạn là trợ lý sức khỏe & dinh dưỡng (trả lời TIẾNG VIỆT), đưa ra gợi ý dựa trên bằng chứng.
-    HƯỚNG DẪN:
-    - Nhấn mạnh: vấn đề nghiêm trọng cần bác sĩ thăm khám trực tiếp.
-    - Đưa lời khuyên phòng ngừa, lối sống, dinh dưỡng, vận động, giấc ngủ, tinh thần.
-    - Đồng cảm, tránh chẩn đoán chắc chắn; gợi ý gặp chuyên gia khi cần.
-    - Đưa khuyến nghị cụ thể, dễ làm; ưu tiên an toàn.
-    {kb_context}
+        prompt = PERSONAL_DOCTOR_PROMPT_TEMPLATE.format(kb_context=kb_context, text_content=text_content)
 
-    Thông tin/ câu hỏi của người dùng:
-    {text_content}
-
-    Vui lòng đưa ra tư vấn ngắn gọn, dễ hiểu, có gạch đầu dòng nếu cần."""
-
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
+        if form.stream:
+            async def done(_: str) -> Dict:
+                return {"success": True}
+            
+            return gemini_event_stream(gemini_model, prompt, done)
+        
+        response = await gemini_dispatcher.submit(gemini_model, prompt)
         
         return {
             "success": True,
@@ -965,7 +2230,6 @@ async def personal_doctor(
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
         print(f"ERROR in personal-doctor endpoint: {str(e)}")
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Error in personal doctor: {str(e)}")
@@ -1010,17 +2274,12 @@ async def create_knowledge_base(kb_request: CreateKBRequest):
         raise HTTPException(status_code=500, detail=f"Error creating knowledge base: {str(e)}")
 
 @app.post("/api/knowledge-bases/delete")
-async def delete_knowledge_base(request: str = Form(None)):
+async def delete_knowledge_base(form: KBForm = Depends(parse_kb_form)):
     """Delete a knowledge base"""
     try:
-        if not request:
-            raise HTTPException(status_code=400, detail="Please provide knowledge base name")
-        
-        request_data = json.loads(request)
-        kb_name = request_data.get("name", "").strip()
-        
+        kb_name = form.name.strip()
         if not kb_name:
-            raise HTTPException(status_code=400, detail="Knowledge base name cannot be empty")
+            raise HTTPException(status_code=400, detail="Please provide knowledge base name")
         
         if kb_manager.delete_kb(kb_name):
             return {
@@ -1035,21 +2294,18 @@ async def delete_knowledge_base(request: str = Form(None)):
         raise HTTPException(status_code=500, detail=f"Error deleting knowledge base: {str(e)}")
 
 @app.post("/api/knowledge-bases/clear")
-async def clear_knowledge_base(request: str = Form(None)):
+async def clear_knowledge_base(form: KBForm = Depends(parse_kb_form)):
     """Clear all documents from a knowledge base"""
     try:
-        if not request:
+        kb_name = form.name.strip()
+        if not kb_name:
             raise HTTPException(status_code=400, detail="Please provide knowledge base name")
         
-        request_data = json.loads(request)
-        kb_name = request_data.get("name", "").strip()
-        
         kb = kb_manager.get_kb(kb_name)
         if not kb:
             raise HTTPException(status_code=404, detail=f"Knowledge base '{kb_name}' not found")
         
         kb.clear()
-        kb_manager.save_to_disk()
         
         return {
             "success": True,
@@ -1063,18 +2319,13 @@ async def clear_knowledge_base(request: str = Form(None)):
 @app.post("/api/knowledge-bases/upload")
 async def upload_to_knowledge_base(
     files: List[UploadFile] = File(None),
-    request: str = Form(None)
+    form: KBForm = Depends(parse_kb_form)
 ):
     """Upload documents to a knowledge base"""
     try:
-        if not request:
-            raise HTTPException(status_code=400, detail="Please provide knowledge base name")
-        
-        request_data = json.loads(request)
-        kb_name = request_data.get("name", "").strip()
-        
+        kb_name = form.name.strip()
         if not kb_name:
-            raise HTTPException(status_code=400, detail="Knowledge base name cannot be empty")
+            raise HTTPException(status_code=400, detail="Please provide knowledge base name")
         
         kb = kb_manager.get_kb(kb_name)
         if not kb:
@@ -1083,24 +2334,28 @@ async def upload_to_knowledge_base(
         if not files or len(files) == 0 or not files[0].filename:
             raise HTTPException(status_code=400, detail="Please upload at least one file")
         
-        # Extract text from files and add to knowledge base
-        uploaded_count = 0
-        for file in files:
-            if file and file.filename:
-                try:
-                    text = await extract_text_from_file(file)
-                    if text and text.strip():
-                        kb.add_document(text, filename=file.filename)
-                        uploaded_count += 1
-                except Exception as e:
-                    print(f"Error processing file {file.filename}: {str(e)}")
-                    continue
-        
-        if uploaded_count == 0:
+        # Extract all files concurrently; a file that fails is skipped rather than failing the upload
+        files = [file for file in files if file and file.filename]
+        results = await asyncio.gather(*(extract_text_from_file(file) for file in files), return_exceptions=True)
+        extracted = []
+        for file, text in zip(files, results):
+            if isinstance(text, Exception):
+                print(f"Error processing file {file.filename}: {str(text)}")
+            elif text and text.strip():
+                extracted.append((file.filename, text))
+        
+        if not extracted:
             raise HTTPException(status_code=400, detail="No valid documents were uploaded")
         
-        # Save to disk after upload
-        kb_manager.save_to_disk()
+        # Embed all passages in one batch before taking the KB lock, so queries are not blocked on the API call
+        await asyncio.to_thread(prefetch_embeddings, [text for _, text in extracted])
+        
+        # One store transaction and one matrix append for the whole upload
+        kb = kb_manager.get_kb(kb_name)
+        if not kb:
+            raise HTTPException(status_code=404, detail=f"Knowledge base '{kb_name}' not found")
+        await asyncio.to_thread(kb.add_documents_bulk, [(text, filename) for filename, text in extracted])
+        uploaded_count = len(extracted)
         
         return {
             "success": True,
@@ -1111,7 +2366,6 @@ async def upload_to_knowledge_base(
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
         print(f"ERROR in upload endpoint: {str(e)}")
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Error uploading to knowledge base: {str(e)}")
@@ -1130,7 +2384,7 @@ async def get_knowledge_base_documents(kb_name: str):
             "filename": doc["filename"],
             "text_preview": doc["text"][:200] + "..." if len(doc["text"]) > 200 else doc["text"],
             "text_length": len(doc["text"])
-        } for doc in kb.documents]
+        } for doc in kb.documents.values()]
         
         return {
             "success": True,
@@ -1208,6 +2462,8 @@ async def delete_memory_endpoint(session_id: str):
     """Clear conversation memory for a session (chat history only)"""
     try:
         memory = await get_memory(session_id)
+        # Stop pending history writes and summary refreshes first; either would recreate what is deleted below
+        memory.discard()
         
         # Delete from database
         if USE_DATABASE:
@@ -1221,6 +2477,10 @@ async def delete_memory_endpoint(session_id: str):
         # Delete file if exists
         if hasattr(memory, 'memory_file') and memory.memory_file and memory.memory_file.exists():
             memory.memory_file.unlink()
+        if hasattr(memory, 'summary_file') and memory.summary_file.exists():
+            memory.summary_file.unlink()
+        if not USE_DATABASE:
+            session_index.remove(session_id)
         
         # Clear in-memory conversations
         memory.conversations = []
@@ -1252,6 +2512,7 @@ async def clear_all_data(session_id: str, data_type: str):
         # 1. Xóa lịch sử chat (Chat History)
         if data_type in ['chat_history', 'all']:
             memory = await get_memory(session_id)
+            memory.discard()
             
             if USE_DATABASE:
                 with get_db_connection() as conn:
@@ -1263,6 +2524,10 @@ async def clear_all_data(session_id: str, data_type: str):
             
             if hasattr(memory, 'memory_file') and memory.memory_file and memory.memory_file.exists():
                 memory.memory_file.unlink()
+            if hasattr(memory, 'summary_file') and memory.summary_file.exists():
+                memory.summary_file.unlink()
+            if not USE_DATABASE:
+                session_index.remove(session_id)
             
             memory.conversations = []
             if session_id in conversation_memories:
@@ -1292,15 +2557,13 @@ async def clear_all_data(session_id: str, data_type: str):
         if data_type in ['knowledge_base', 'all']:
             # Get all knowledge bases for this session
             # Note: KB is currently global, but we can filter by session
-            cleared_kbs = []
-            for kb_name in list(kb_manager.knowledge_bases.keys()):
-                try:
-                    kb_manager.delete_kb(kb_name)
-                    cleared_kbs.append(kb_name)
-                except:
-                    pass
+            try:
+                cleared_kbs = kb_manager.delete_all()
+            except Exception as e:
+                print(f"[WARNING] Failed to delete knowledge bases: {e}")
+                cleared_kbs = 0
             
-            result["cleared"].append(f"knowledge_base ({len(cleared_kbs)} kho)")
+            result["cleared"].append(f"knowledge_base ({cleared_kbs} kho)")
         
         # Build message
         if data_type == 'all':
@@ -1321,6 +2584,7 @@ async def clear_all_data(session_id: str, data_type: str):
 async def get_data_stats(session_id: str):
     """Get data statistics for settings page"""
     try:
+        kbs = kb_manager.list_kbs()
         stats = {
             "chat_history": {
                 "message_count": 0,
@@ -1332,9 +2596,9 @@ async def get_data_stats(session_id: str):
                 "items": []
             },
             "knowledge_bases": {
-                "kb_count": len(kb_manager.knowledge_bases),
-                "total_documents": sum(len(kb.documents) for kb in kb_manager.knowledge_bases.values()),
-                "kb_names": list(kb_manager.knowledge_bases.keys())
+                "kb_count": len(kbs),
+                "total_documents": sum(kb["document_count"] for kb in kbs),
+                "kb_names": [kb["name"] for kb in kbs]
             }
         }
         
@@ -1389,24 +2653,36 @@ async def export_memory_endpoint(session_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi xuất dữ liệu: {str(e)}")
 
+def _list_db_sessions() -> List[Dict]:
+    """Per-session message counts straight from conversation_messages"""
+    with get_db_connection() as conn:
+        if not conn:
+            return []
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT session_id, COUNT(*), MAX(timestamp) FROM conversation_messages GROUP BY session_id'
+        )
+        return [
+            {"session_id": row[0], "message_count": row[1], "updated_at": row[2].isoformat() if row[2] else None}
+            for row in cursor.fetchall()
+        ]
+
 @app.get("/api/memory")
 async def list_all_memories():
     """List all available conversation sessions"""
     try:
-        sessions = []
-        if CONVERSATION_STORAGE_DIR.exists():
-            for memory_file in CONVERSATION_STORAGE_DIR.glob("user_*.json"):
-                try:
-                    with open(memory_file, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                        sessions.append({
-                            "session_id": data.get("user_id"),
-                            "message_count": len(data.get("conversations", [])),
-                            "updated_at": data.get("updated_at"),
-                            "file": str(memory_file)
-                        })
-                except:
-                    pass
+        if USE_DATABASE:
+            sessions = await asyncio.to_thread(_list_db_sessions)
+        else:
+            sessions = [
+                {
+                    "session_id": session_id,
+                    "message_count": message_count,
+                    "updated_at": updated_at,
+                    "file": str(CONVERSATION_STORAGE_DIR / f"user_{session_id}.jsonl.gz")
+                }
+                for session_id, message_count, updated_at in await asyncio.to_thread(session_index.list_sessions)
+            ]
         
         return {
             "success": True,
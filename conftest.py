@@ -0,0 +1,36 @@
+"""Shared fixtures for the api/index.py tests"""
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).parent
+EMBEDDING_DIM = 768
+
+
+def fake_embed_content(model=None, content=None, task_type=None, **kwargs):
+    """Offline stand-in for genai.embed_content: a hashed bag-of-words vector per text"""
+    def vector(text):
+        v = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+        for word in text.lower().split():
+            v[int(hashlib.md5(word.encode()).hexdigest(), 16) % EMBEDDING_DIM] += 1
+        v[0] += 1e-3  # Keep empty texts from producing a zero vector
+        return v.tolist()
+    if isinstance(content, str):
+        return {"embedding": vector(content)}
+    return {"embedding": [vector(text) for text in content]}
+
+
+@pytest.fixture(scope="session")
+def index(tmp_path_factory):
+    """api/index.py imported inside a scratch directory, with Gemini embeddings computed locally"""
+    os.chdir(tmp_path_factory.mktemp("bassist"))
+    os.environ.setdefault("GEMINI_API_KEY", "test")
+    sys.path.insert(0, str(ROOT / "api"))
+    import google.generativeai as genai
+    genai.embed_content = fake_embed_content
+    import index as module
+    return module
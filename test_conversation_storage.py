@@ -0,0 +1,133 @@
+"""Tests for the file-backed conversation history in api/index.py"""
+import asyncio
+import gzip
+import json
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def storage(index, tmp_path, monkeypatch):
+    """Point file-backed histories and the session index at an empty directory"""
+    monkeypatch.setattr(index, "CONVERSATION_STORAGE_DIR", tmp_path)
+    monkeypatch.setattr(index, "session_index", index.SessionIndex(tmp_path / "index.db"))
+    return tmp_path
+
+
+def read_history(path):
+    with gzip.open(path, "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_messages_round_trip_through_gzip_history(index, storage):
+    memory = index.ConversationMemory("roundtrip")
+    memory.add_messages([("user", "Xin chào"), ("assistant", "Chào bạn ☀️")])
+    memory.add_message("user", "hỏi tiếp")
+    memory.flush()
+
+    history = read_history(storage / "user_roundtrip.jsonl.gz")
+    assert [msg["content"] for msg in history] == ["Xin chào", "Chào bạn ☀️", "hỏi tiếp"]
+    assert all(isinstance(msg["ts"], int) for msg in history)
+    assert [msg["content"] for msg in index.ConversationMemory("roundtrip").conversations] == [
+        "Xin chào", "Chào bạn ☀️", "hỏi tiếp"
+    ]
+    assert index.session_index.list_sessions()[0][:2] == ("roundtrip", 3)
+
+
+def test_torn_gzip_tail_is_dropped_and_rewritten(index, storage):
+    memory = index.ConversationMemory("torn")
+    memory.add_messages([("user", "one"), ("assistant", "two")])
+    memory.flush()
+    path = storage / "user_torn.jsonl.gz"
+    # A crash mid-append leaves a truncated trailing gzip member
+    member = gzip.compress(b'{"role": "user", "content": "lost"}\n' * 50)
+    with open(path, "ab") as f:
+        f.write(member[: len(member) // 2])
+
+    reloaded = index.ConversationMemory("torn")
+    assert [msg["content"] for msg in reloaded.conversations] == ["one", "two"]
+    # The file was rewritten, so it reads cleanly and later appends stay readable
+    assert [msg["content"] for msg in read_history(path)] == ["one", "two"]
+    reloaded.add_message("user", "three")
+    reloaded.flush()
+    assert [msg["content"] for msg in read_history(path)] == ["one", "two", "three"]
+
+
+def test_legacy_json_history_is_converted(index, storage):
+    legacy = storage / "user_legacy.json"
+    legacy.write_text(json.dumps({
+        "user_id": "legacy",
+        "updated_at": "2026-01-22T10:00:00",
+        "conversations": [
+            {"role": "user", "content": "What is AI?", "timestamp": "2026-01-22T10:00:00", "kb": None},
+            {"role": "assistant", "content": "AI is...", "timestamp": "2026-01-22T10:00:05", "kb": "my-kb"},
+        ],
+    }), encoding="utf-8")
+
+    memory = index.ConversationMemory("legacy")
+    assert not legacy.exists()
+    history = read_history(storage / "user_legacy.jsonl.gz")
+    assert [msg["content"] for msg in history] == ["What is AI?", "AI is..."]
+    assert history[1]["ts"] - history[0]["ts"] == 5000
+    assert "timestamp" not in history[0]
+    assert memory.conversations == history
+
+
+def test_plain_jsonl_history_is_converted(index, storage):
+    plain = storage / "user_plain.jsonl"
+    plain.write_bytes(
+        b'{"role": "user", "content": "old", "timestamp": "2026-01-22T10:00:00"}\n'
+        b'{"role": "assistant", "content": "reply", "ts": 1769076005000}\n'
+    )
+
+    memory = index.ConversationMemory("plain")
+    assert not plain.exists()
+    assert [msg["content"] for msg in read_history(storage / "user_plain.jsonl.gz")] == ["old", "reply"]
+    assert all("ts" in msg and "timestamp" not in msg for msg in memory.conversations)
+
+
+def test_session_index_is_built_from_existing_files(index, storage):
+    with gzip.open(storage / "user_a.jsonl.gz", "wb") as f:
+        f.write(b'{"role": "user", "content": "x"}\n' * 2)
+    (storage / "user_b.jsonl").write_bytes(b'{"role": "user", "content": "y"}\n')
+    (storage / "user_c.json").write_text(json.dumps({"user_id": "c", "conversations": [{}] * 3}))
+
+    rebuilt = index.SessionIndex(storage / "rebuilt.db")
+    assert sorted(row[:2] for row in rebuilt.list_sessions()) == [("a", 2), ("b", 1), ("c", 3)]
+    rebuilt.remove("b")
+    assert sorted(row[0] for row in rebuilt.list_sessions()) == ["a", "c"]
+
+
+def test_history_deleted_during_summary_refresh_stays_deleted(index, storage, monkeypatch):
+    """A refresh still waiting on the model must not write the summary back after the delete"""
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_generate(model, prompt, stream=False):
+            started.set()
+            await release.wait()
+            return SimpleNamespace(text="tóm tắt cũ")
+
+        monkeypatch.setattr(index, "gemini_generate", slow_generate)
+        memory = await index.get_memory("summarized")
+        turns = index.RECENT_CONTEXT_MESSAGES + index.SUMMARY_EVERY_MESSAGES
+        await memory.add_messages_async([("user", f"tin nhắn {i}") for i in range(turns)])
+        await started.wait()
+        task = memory._summary_task
+
+        await index.delete_memory_endpoint("summarized")
+        release.set()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert not (storage / "summary_summarized.json").exists()
+    fresh = index.ConversationMemory("summarized")
+    assert fresh.conversations == [] and fresh.summary == ""
+
+
+def test_summary_outliving_its_history_is_ignored(index, storage):
+    (storage / "summary_orphan.json").write_text(json.dumps({"summary": "cũ", "summary_upto": 30}))
+    memory = index.ConversationMemory("orphan")
+    assert memory.summary == "" and memory.summary_upto == 0
@@ -0,0 +1,182 @@
+"""Tests for knowledge base retrieval and storage in api/index.py"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+
+def test_bm25_only_exact_match_reaches_top_k(index, monkeypatch):
+    """A passage found only by keyword search must still beat vector hits ranked below top_k"""
+    pytest.importorskip("rank_bm25")
+    kb = index.KnowledgeBase("rrf")
+    for i in range(60):
+        kb.add_document(f"general notes about widgets and gadgets number {i}", f"doc{i}.txt")
+    target = kb.add_document("replacement gasket for the XJ9000 pump", "xj.txt")
+    kb._ensure_embeddings()
+    target_row = kb._doc_rows[target][0]
+    # Simulate an embedding that misses the model number: the target is absent from the vector ranking
+    vector_rows = [row for row in range(len(kb.embedding_ids)) if row != target_row]
+    monkeypatch.setattr(kb, "_search", lambda query_vec, top_k: vector_rows[:top_k])
+
+    rows = kb._hybrid_search("XJ9000", np.zeros(768, dtype=np.float32), 3)
+    assert target_row in rows
+
+
+def test_chunk_spans_cover_text_with_overlap(index):
+    """Windows stay within CHUNK_SIZE, overlap their neighbour and together cover the whole text"""
+    text = " ".join(f"word{i}" for i in range(2000))
+    spans = index._chunk(text)
+    assert spans[0][0] == 0 and spans[-1][1] == len(text)
+    for (start, end), (next_start, next_end) in zip(spans, spans[1:]):
+        assert end - start <= index.CHUNK_SIZE
+        assert next_start < end  # Consecutive windows share text
+        assert next_start > start
+    assert index._chunk("") == []
+    assert index._chunk("short") == [(0, 5)]
+
+
+def test_chunk_prefers_paragraph_boundaries(index):
+    paragraph = "Một câu văn bản. " * 60
+    text = "\n\n".join([paragraph] * 6)
+    spans = index._chunk(text)
+    assert len(spans) > 1
+    assert all(text[end - 2:end] == "\n\n" for _, end in spans[:-1])
+
+
+def test_query_merges_overlapping_passages_of_one_document(index):
+    """Overlapping matching chunks of one document come back as a single passage without repeated text"""
+    kb = index.KnowledgeBase("merge")
+    text = " ".join(f"zebra{i:04d}" for i in range(400))
+    kb.add_document(text, "zebra.txt")
+    kb._ensure_embeddings()
+    assert len(kb.embedding_ids) == 3  # Three overlapping windows
+    assert kb.query("zebra0001 zebra0200", top_k=3) == [text]
+
+
+def test_concurrent_queries_embed_outside_the_kb_lock(index, monkeypatch):
+    """Query embeddings are network calls, so queries on one KB must not wait on each other's"""
+    kb = index.KnowledgeBase("concurrent")
+    kb.add_document("shared knowledge base text", "shared.txt")
+    kb._ensure_embeddings()
+    queries = 4
+    barrier = threading.Barrier(queries, timeout=5)
+    embed = index.query_embedding_cache.embed
+
+    def rendezvous_embed(text):
+        barrier.wait()  # Breaks if another query's embedding is stuck behind the lock
+        return embed(text)
+
+    monkeypatch.setattr(index.query_embedding_cache, "embed", rendezvous_embed)
+    with ThreadPoolExecutor(queries) as pool:
+        list(pool.map(lambda i: kb.query(f"query {i}"), range(queries)))
+    assert not barrier.broken
+
+
+def test_hybrid_search_prefers_passages_found_by_both_rankings(index):
+    pytest.importorskip("rank_bm25")
+    kb = index.KnowledgeBase("both")
+    for i in range(10):
+        kb.add_document(f"filler text about topic {i}", f"f{i}.txt")
+    target = kb.add_document("solar panel inverter maintenance", "solar.txt")
+    results = kb.query("solar inverter maintenance", top_k=1)
+    assert results == [kb.documents[target]["text"]]
+
+
+def test_removed_documents_are_tombstoned_then_compacted(index):
+    kb = index.KnowledgeBase("tombstones")
+    ids = [kb.add_document(f"document body number {i} apple", f"d{i}.txt") for i in range(6)]
+    kb._ensure_embeddings()
+    assert len(kb.embedding_ids) == 6
+
+    kb.remove_document(ids[0])
+    kb.remove_document(ids[1])
+    assert kb._tombstones == 2
+    assert kb.embedding_ids.count(None) == 2
+    assert all(kb.embedding_ids[row] is not None for row in kb._search_index(kb.embeddings[0].astype(np.float32), 6))
+
+    # Crossing half of the table triggers compaction: rows are dropped and row maps rebuilt
+    kb.remove_document(ids[2])
+    kb.remove_document(ids[3])
+    assert kb._tombstones == 0
+    assert kb.embedding_ids == [ids[4], ids[5]]
+    assert len(kb.embeddings) == 2
+    assert kb._doc_rows == {ids[4]: [0], ids[5]: [1]}
+    assert {doc for doc in kb.query("apple", top_k=5)} <= {kb.documents[i]["text"] for i in ids[4:]}
+
+
+def test_cold_start_rehydrates_embeddings_from_the_store(index, tmp_path, monkeypatch):
+    """A fresh worker loading a KB reuses the persisted vectors instead of calling Gemini again"""
+    kb_path, embeddings_path = str(tmp_path / "kb.db"), str(tmp_path / "emb.db")
+    monkeypatch.setattr(index, "embedding_store", index.EmbeddingStore(embeddings_path))
+    store = index.KnowledgeBaseStore(kb_path)
+    store.create_kb("cold")
+    kb = store.load_kb("cold")
+    kb.add_documents_bulk([(" ".join(f"term{i}x{j}" for j in range(300)), f"{i}.txt") for i in range(3)])
+    kb._ensure_embeddings()
+    warm_vectors = kb.embeddings.copy()
+
+    # Simulate a cold start: new connections to both databases, and Gemini unreachable
+    monkeypatch.setattr(index, "embedding_store", index.EmbeddingStore(embeddings_path))
+    def no_network(**kwargs):
+        raise AssertionError("embed_content called for a stored passage")
+    monkeypatch.setattr(index.genai, "embed_content", no_network)
+    cold = index.KnowledgeBaseStore(kb_path).load_kb("cold")
+    assert cold.embeddings is None
+
+    cold._ensure_embeddings()
+    assert np.array_equal(cold.embeddings, warm_vectors)
+    assert cold.embedding_ids == kb.embedding_ids
+
+
+def test_store_allocates_unique_ids_and_counts_documents(index, tmp_path):
+    path = str(tmp_path / "kb.db")
+    store = index.KnowledgeBaseStore(path)
+    other_worker = index.KnowledgeBaseStore(path)
+    store.create_kb("kb")
+
+    first = store.insert_documents("kb", [("a", "a.txt"), ("b", "b.txt")])
+    second = other_worker.insert_documents("kb", [("c", "c.txt")])
+    assert first == [0, 1] and second == [2]
+    assert store.list_kbs() == [("kb", 3)]
+
+    store.delete_document("kb", 1)
+    store.delete_document("kb", 1)  # Deleting twice must not decrement twice
+    assert other_worker.list_kbs() == [("kb", 2)]
+    assert sorted(store.load_kb("kb").documents) == [0, 2]
+
+    store.clear_kb("kb")
+    assert store.list_kbs() == [("kb", 0)]
+    assert store.insert_documents("kb", [("d", "d.txt")]) == [0]
+
+    with pytest.raises(ValueError):
+        store.insert_documents("missing", [("x", "x.txt")])
+
+
+def test_store_import_derives_next_id_from_documents(index, tmp_path):
+    """Legacy pickles could carry next_id = 0 while holding documents"""
+    store = index.KnowledgeBaseStore(str(tmp_path / "kb.db"))
+    legacy = index.KnowledgeBase("legacy")
+    legacy.documents = {
+        4: {"id": 4, "text": "four", "filename": "4.txt", "uploaded_at": None},
+        7: {"id": 7, "text": "seven", "filename": "7.txt", "uploaded_at": None},
+    }
+    store.import_kb(legacy)
+    assert store.list_kbs() == [("legacy", 2)]
+    assert store.insert_documents("legacy", [("new", "new.txt")]) == [8]
+
+
+def test_store_backfills_doc_count_for_older_databases(index, tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE kbs (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL DEFAULT 0, created_at TEXT);
+        CREATE TABLE kb_docs (kb_name TEXT NOT NULL, doc_id INTEGER NOT NULL, filename TEXT,
+                              text TEXT NOT NULL, uploaded_at TEXT, PRIMARY KEY (kb_name, doc_id));
+        INSERT INTO kbs VALUES ('x', 2, NULL);
+        INSERT INTO kb_docs VALUES ('x', 0, 'a', 't', NULL), ('x', 1, 'b', 't', NULL);
+    """)
+    conn.commit()
+    conn.close()
+    assert index.KnowledgeBaseStore(path).list_kbs() == [("x", 2)]
@@ -0,0 +1,82 @@
+"""Server-sent event responses of the endpoints that accept "stream": true"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+class FakeStream:
+    """Async iterator over text chunks, shaped like a streamed Gemini response"""
+    def __init__(self, texts):
+        self._texts = list(texts)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._texts:
+            raise StopAsyncIteration
+        return SimpleNamespace(text=self._texts.pop(0))
+
+
+class FakeModel:
+    model_name = "fake"
+
+    async def generate_content_async(self, prompt, stream=False):
+        if stream:
+            return FakeStream(["Xin ", "chào"])
+        return SimpleNamespace(text="Xin chào")
+
+
+@pytest.fixture
+def client(index, monkeypatch):
+    monkeypatch.setattr(index, "gemini_model", FakeModel())
+    return TestClient(index.app)
+
+
+def stream_events(client, path, payload):
+    response = client.post(path, data={"request": json.dumps({**payload, "stream": True})})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+
+@pytest.mark.parametrize("path", ["/api/study-buddy", "/api/polisher", "/api/personal-doctor"])
+def test_stream_relays_deltas_then_done(client, path):
+    events = stream_events(client, path, {"text": "Quang hợp là gì?"})
+    assert [event["delta"] for event in events[:-1]] == ["Xin ", "chào"]
+    assert events[-1]["done"] is True
+    assert events[-1]["success"] is True, events[-1]
+
+
+def test_chat_stream_saves_turn_after_completion(client, index):
+    events = stream_events(client, "/api/chat", {"text": "Chào bạn", "session_id": "stream-test"})
+    done = events[-1]
+    assert done["success"] is True, done
+    assert done["session_id"] == "stream-test"
+    assert done["memory_messages"] == 2
+    memory = index.conversation_memories["stream-test"]
+    assert [m["content"] for m in memory.conversations] == ["Chào bạn", "Xin chào"]
+
+
+def test_stream_holds_a_gemini_slot_until_drained(client, index, monkeypatch):
+    """Streamed generations count against GEMINI_MAX_CONCURRENT for as long as they produce chunks"""
+    semaphore = asyncio.Semaphore(1)
+    monkeypatch.setattr(index, "gemini_semaphore", semaphore)
+    held = []
+
+    class WatchedStream(FakeStream):
+        async def __anext__(self):
+            held.append(semaphore.locked())
+            return await super().__anext__()
+
+    async def generate_content_async(prompt, stream=False):
+        return WatchedStream(["a", "b"])
+
+    monkeypatch.setattr(index.gemini_model, "generate_content_async", generate_content_async)
+    events = stream_events(client, "/api/study-buddy", {"text": "x"})
+    assert events[-1]["success"] is True
+    assert held and all(held)
+    assert not semaphore.locked()